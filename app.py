@@ -1,117 +1,1694 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, abort, current_app, g, has_request_context, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import and_, event, inspect, or_, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import base64
+import click
+import cProfile
+import hashlib
+import heapq
+import json
 import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+from cache import ResponseCache
+from ical import calendar_footer, calendar_header, event_to_schedule, format_event, iter_events
+from intervals import DayIntervalIndex
+from metrics import QUERY_COUNT_BUCKETS, SIZE_BUCKETS, Registry
+from recurrence import Rule, occurrences
+from search import index_terms, parse_query
+from validation import ValidationError, parse_date, parse_datetime, parse_schedule, parse_schedules, parse_time
 
-load_dotenv()
+# 导入本模块不创建应用，也不读取环境变量；应用由入口（Procfile、asgi.py、flask 命令）调用 create_app 创建。
+# create_app 不访问数据库：引擎在第一次使用时才创建，表结构由 flask migrate 单独升级，
+# worker 启动时不做任何结构或数据上的工作
+db = SQLAlchemy()
+bp = Blueprint('schedules', __name__, cli_group=None)
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///schedules.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
+def create_app(config=None):
+    # 环境变量可写在 .env 中，已设置的环境变量优先
+    load_dotenv()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///schedules.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(
+        # 认证：REQUIRE_AUTH=1 时必须携带令牌，否则未携带令牌的请求使用匿名用户的数据
+        REQUIRE_AUTH=os.environ.get('REQUIRE_AUTH', '0') == '1',
+        # flask archive 把日期早于今天减去该天数的单次日程移入归档表；查询范围不早于该日期时不读取归档表
+        ARCHIVE_AFTER_DAYS=int(os.environ.get('ARCHIVE_AFTER_DAYS', 365)),
+        # 日历订阅的名称
+        CALENDAR_NAME=os.environ.get('CALENDAR_NAME', 'Schedule Planner'),
+        # 进程内按用户维护的区间索引、日历快照等最多保留的用户数
+        MAX_CACHED_OWNERS=int(os.environ.get('MAX_CACHED_OWNERS', 1000)),
+        # 响应缓存容量（字节）；其它 worker 的写入最多延迟 CHANGE_SEQ_TTL 秒被本进程看到
+        RESPONSE_CACHE_BYTES=int(os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024)),
+        CHANGE_SEQ_TTL=float(os.environ.get('CHANGE_SEQ_TTL', 1)),
+        # 超过该耗时（秒）或 SQL 查询数的请求记录警告日志，查询数过多通常意味着 N+1 查询
+        SLOW_REQUEST_SECONDS=float(os.environ.get('SLOW_REQUEST_MS', 1000)) / 1000,
+        MAX_QUERIES_PER_REQUEST=int(os.environ.get('MAX_QUERIES_PER_REQUEST', 50)),
+        # 设为 1 后，带 X-Profile 请求头的请求和按 PROFILE_SAMPLE_RATE 抽样的请求由 cProfile 分析，
+        # 结果保存到 PROFILE_DIR，默认为实例目录下的 profiles
+        ENABLE_PROFILING=os.environ.get('ENABLE_PROFILING', '0') == '1',
+        PROFILE_SAMPLE_RATE=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+        PROFILE_DIR=os.environ.get('PROFILE_DIR'),
+    )
+    app.config.update(config or {})
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # 每个 gunicorn worker 进程各有一个连接池，默认大小与 worker 的线程数一致（见 Procfile）
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', os.environ.get('GUNICORN_THREADS', 4))),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 2)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            # 取出连接前检测是否已断开，并定期重建连接，避免使用被数据库或负载均衡关闭的空闲连接
+            'pool_pre_ping': True,
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        })
+    app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
+    app.extensions['schedules'] = AppState(app.config)
+    db.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
-db = SQLAlchemy(app)
+# 分页参数
+MAX_PAGE_SIZE = 1000
+# 搜索结果未指定 limit 时的每页条数
+SEARCH_PAGE_SIZE = 50
+# 提醒查询最多回溯的时间，避免长时间离线的客户端一次拉取过多提醒
+MAX_REMINDER_LOOKBACK = timedelta(days=1)
+# 计算重复日程下一次提醒时向后查找的天数
+REMINDER_HORIZON_DAYS = 2
+# 空闲时段查询的最大日期跨度
+MAX_FREE_SLOT_DAYS = 366
+# 新建或修改重复日程时检查冲突的最大日期跨度，覆盖次数上限内的每日重复
+MAX_CONFLICT_DAYS = 3 * 366
+# 用时统计的最大日期跨度和按标题统计返回的条数
+MAX_STATS_DAYS = 366
+STATS_TOP_TITLES = 20
+# flask archive 每个事务移动的日程数
+ARCHIVE_BATCH_SIZE = 1000
+# 批量接口：单次最多操作数、IN 查询分块大小
+MAX_BATCH_SIZE = 10000
+BATCH_CHUNK_SIZE = 500
+# 变更订阅：轮询变更计数器的间隔、长轮询最长等待、SSE 连接最长持续时间（秒）
+CHANGE_POLL_INTERVAL = 0.5
+MAX_CHANGE_WAIT = 30
+SSE_MAX_DURATION = 300
+SSE_KEEPALIVE = 15
+# 导出时每次从数据库游标读取的行数、导入时每个事务写入的行数、导入结果中最多列出的错误数
+EXPORT_CHUNK_SIZE = 1000
+IMPORT_CHUNK_SIZE = 1000
+# 导入时每次从请求体读取的字节数
+IMPORT_READ_SIZE = 64 * 1024
+MAX_IMPORT_ERRORS = 100
+# 未携带令牌的请求使用的匿名用户，令牌对应的用户 id 在进程内缓存的秒数
+ANONYMOUS_OWNER = 0
+TOKEN_CACHE_TTL = 60
 
-class Schedule(db.Model):
+# SQLite 中沿用旧数据的 "HH:MM" / "YYYY-MM-DD HH:MM" 文本格式，已有数据无需改写
+Time = db.Time().with_variant(
+    sqlite.TIME(storage_format='%(hour)02d:%(minute)02d', regexp=r'(\d+):(\d+)'), 'sqlite')
+DateTime = db.DateTime().with_variant(
+    sqlite.DATETIME(storage_format='%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d',
+                    regexp=r'(\d+)-(\d+)-(\d+) (\d+):(\d+)'), 'sqlite')
+
+class ScheduleColumns:
+    # 日程表和归档表共用的列和序列化方法
     id = db.Column(db.Integer, primary_key=True)
+    # 所属用户，0 为匿名用户
+    owner_id = db.Column(db.Integer, nullable=False, default=0)
     title = db.Column(db.String(100), nullable=False)
-    date = db.Column(db.String(10), nullable=False)
-    start_time = db.Column(db.String(5), nullable=False)
-    end_time = db.Column(db.String(5), nullable=False)
-    reminder_time = db.Column(db.String(5), nullable=True)
+    date = db.Column(db.Date, nullable=False)
+    start_time = db.Column(Time, nullable=False)
+    end_time = db.Column(Time, nullable=False)
+    reminder_time = db.Column(Time, nullable=True)
+    # 提醒触发时刻，由 date 和 reminder_time 派生
+    remind_at = db.Column(DateTime, nullable=True)
+    # 最近一次写入时所属用户的变更序号
+    seq = db.Column(db.Integer, nullable=False, default=0)
+    # 重复规则，只存一份，查询时按窗口展开；recur_end 为最后一次可能发生的日期，无限重复时为空
+    recur_freq = db.Column(db.String(10), nullable=True)
+    recur_interval = db.Column(db.Integer, nullable=True)
+    recur_count = db.Column(db.Integer, nullable=True)
+    recur_until = db.Column(db.Date, nullable=True)
+    recur_exdates = db.Column(db.Text, nullable=True)
+    recur_end = db.Column(db.Date, nullable=True)
+
+    def rule(self):
+        return make_rule(self.date, self.recur_freq, self.recur_interval, self.recur_count,
+                         self.recur_until, self.recur_exdates)
 
     def to_dict(self):
-        return {
+        result = {
             'id': self.id,
             'title': self.title,
-            'date': self.date,
-            'start_time': self.start_time,
-            'end_time': self.end_time,
-            'reminder_time': self.reminder_time
+            'date': self.date.isoformat(),
+            'start_time': self.start_time.strftime('%H:%M'),
+            'end_time': self.end_time.strftime('%H:%M'),
+            'reminder_time': self.reminder_time.strftime('%H:%M') if self.reminder_time else None
         }
+        if self.recur_freq:
+            result['recurrence'] = {
+                'freq': self.recur_freq,
+                'interval': self.recur_interval,
+                'count': self.recur_count,
+                'until': self.recur_until.isoformat() if self.recur_until else None,
+                'exdates': self.recur_exdates.split(',') if self.recur_exdates else []
+            }
+        return result
+
+    def occurrence_dict(self, date):
+        # 重复日程在某一天的发生，id 仍为规则所在的日程
+        result = self.to_dict()
+        result['date'] = date.isoformat()
+        return result
+
+    def sort_key(self):
+        return self.date, self.start_time, self.id
+
+class Schedule(ScheduleColumns, db.Model):
+    # 所有查询都限定在一个用户内，索引均以 owner_id 开头，单个用户的查询代价与用户数无关
+    __table_args__ = (
+        # 覆盖 (owner_id, date, start_time, id) 的复合索引，用于范围查询和键集分页
+        db.Index('ix_schedule_owner_date_start_time_id', 'owner_id', 'date', 'start_time', 'id'),
+        # 查找与窗口相交的重复日程
+        db.Index('ix_schedule_owner_recur_freq_end', 'owner_id', 'recur_freq', 'recur_end'),
+        db.Index('ix_schedule_owner_remind_at', 'owner_id', 'remind_at'),
+        db.Index('ix_schedule_owner_seq', 'owner_id', 'seq'),
+        # SQLite 默认会重用最大的已删除 id，归档表中的 id 必须不再分配
+        {'sqlite_autoincrement': True},
+    )
+
+class ArchivedSchedule(ScheduleColumns, db.Model):
+    # 早于归档期限的单次日程，由 flask archive 从 schedule 表移入，id 不变并取新的 seq；修改或删除前先移回 schedule 表
+    __tablename__ = 'schedule_archive'
+    __table_args__ = (
+        db.Index('ix_schedule_archive_owner_date_start_time_id', 'owner_id', 'date', 'start_time', 'id'),
+        db.Index('ix_schedule_archive_owner_seq', 'owner_id', 'seq'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+def make_rule(date, freq, interval, count, until, exdates):
+    if not freq:
+        return None
+    exdates = tuple(parse_date(day) for day in exdates.split(',')) if exdates else ()
+    return Rule(date, freq, interval or 1, count, until, exdates)
+
+class Tombstone(db.Model):
+    # 已删除日程的墓碑，供变更订阅下发删除
+    __tablename__ = 'schedule_tombstone'
+    __table_args__ = (db.Index('ix_schedule_tombstone_owner_seq', 'owner_id', 'seq'),)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    owner_id = db.Column(db.Integer, nullable=False, default=0)
+    seq = db.Column(db.Integer, nullable=False)
+
+class HourlyUsage(db.Model):
+    # 单次日程按用户、日期和小时汇总的占用分钟数，starts 为在该小时开始的日程数；重复日程在查询时展开，不计入
+    __tablename__ = 'usage_hourly'
+    owner_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+    starts = db.Column(db.Integer, nullable=False, default=0)
+
+class TitleUsage(db.Model):
+    # 单次日程按用户和标题汇总的占用分钟数和日程数
+    __tablename__ = 'usage_title'
+    # 按用时取前几个标题时沿索引倒序读取，不需要排序全部标题
+    __table_args__ = (db.Index('ix_usage_title_owner_minutes_title', 'owner_id', 'minutes', 'title'),)
+    owner_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(100), primary_key=True)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class User(db.Model):
+    __tablename__ = 'app_user'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    # 只保存访问令牌的 SHA-256 摘要
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+
+class ChangeCounter(db.Model):
+    # 每个用户一个变更计数器，见 counter_name
+    __tablename__ = 'change_counter'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+def schedule_columns(conn):
+    return {column['name']: column['type'] for column in inspect(conn).get_columns('schedule')}
+
+def add_remind_at(conn):
+    if 'remind_at' not in schedule_columns(conn):
+        conn.execute(text('ALTER TABLE schedule ADD COLUMN remind_at VARCHAR(16)'))
+        conn.execute(text(
+            "UPDATE schedule SET remind_at = date || ' ' || reminder_time "
+            "WHERE reminder_time IS NOT NULL AND reminder_time != ''"
+        ))
+
+def add_change_seq(conn):
+    if 'seq' not in schedule_columns(conn):
+        # 已有数据视为第 1 次变更，since=0 的订阅者可以拿到全部数据
+        conn.execute(text('ALTER TABLE schedule ADD COLUMN seq INTEGER NOT NULL DEFAULT 0'))
+        conn.execute(text('UPDATE schedule SET seq = 1'))
+
+def use_native_time_types(conn):
+    if conn.dialect.name == 'postgresql':
+        if isinstance(schedule_columns(conn)['date'], db.String):
+            conn.execute(text(
+                'ALTER TABLE schedule '
+                'ALTER COLUMN date TYPE DATE USING date::date, '
+                'ALTER COLUMN start_time TYPE TIME USING start_time::time, '
+                'ALTER COLUMN end_time TYPE TIME USING end_time::time, '
+                "ALTER COLUMN reminder_time TYPE TIME USING NULLIF(reminder_time, '')::time, "
+                "ALTER COLUMN remind_at TYPE TIMESTAMP USING NULLIF(remind_at, '')::timestamp"
+            ))
+    else:
+        # SQLite 仍按文本存储并按字符串比较：旧数据可能是 "9:05"、"2024-3-1" 这类未补零的写法，
+        # 逐行解析后按新格式写回，remind_at 随之重算；空字符串和无法解析的提醒时间清空
+        rows = conn.execute(text('SELECT id, date, start_time, end_time, reminder_time FROM schedule')).fetchall()
+        for id, day, start, end, reminder in rows:
+            values = {'id': id, 'reminder_time': None, 'remind_at': None}
+            try:
+                values['date'] = parse_date(day).isoformat()
+                values['start_time'] = parse_time(start).strftime('%H:%M')
+                values['end_time'] = parse_time(end).strftime('%H:%M')
+            except ValidationError:
+                continue
+            if reminder:
+                try:
+                    values['reminder_time'] = parse_time(reminder).strftime('%H:%M')
+                except ValidationError:
+                    pass
+                else:
+                    values['remind_at'] = f"{values['date']} {values['reminder_time']}"
+            conn.execute(text(
+                'UPDATE schedule SET date = :date, start_time = :start_time, end_time = :end_time, '
+                'reminder_time = :reminder_time, remind_at = :remind_at WHERE id = :id'
+            ), values)
+
+def add_recurrence(conn):
+    columns = schedule_columns(conn)
+    for name, type in [('recur_freq', 'VARCHAR(10)'), ('recur_interval', 'INTEGER'), ('recur_count', 'INTEGER'),
+                       ('recur_until', 'DATE'), ('recur_exdates', 'TEXT'), ('recur_end', 'DATE')]:
+        if name not in columns:
+            conn.execute(text(f'ALTER TABLE schedule ADD COLUMN {name} {type}'))
+
+def add_owner(conn):
+    # 已有数据归匿名用户；以 owner_id 开头的新索引在迁移后统一创建，旧索引删除
+    for table in ('schedule', 'schedule_tombstone'):
+        if 'owner_id' not in {column['name'] for column in inspect(conn).get_columns(table)}:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN owner_id INTEGER NOT NULL DEFAULT 0'))
+    for table, name in [('schedule', 'ix_schedule_date_start_time_id'), ('schedule', 'ix_schedule_recur_freq_end'),
+                        ('schedule', 'ix_schedule_remind_at'), ('schedule', 'ix_schedule_seq'),
+                        ('schedule_tombstone', 'ix_schedule_tombstone_seq')]:
+        if name in {index['name'] for index in inspect(conn).get_indexes(table)}:
+            conn.execute(text(f'DROP INDEX {name}'))
+
+def sqlite_search_ddl(table):
+    # SQLite 的标题全文索引：内容不另存的 FTS5 表 <table>_fts，词元由 schedule_ngrams 生成，触发器保持与表同步
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(terms, content='')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {table}_fts (rowid, terms) VALUES (new.id, schedule_ngrams(new.title)); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {table}_fts ({table}_fts, rowid, terms) VALUES ('delete', old.id, schedule_ngrams(old.title)); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF title ON {table} BEGIN "
+        f"INSERT INTO {table}_fts ({table}_fts, rowid, terms) VALUES ('delete', old.id, schedule_ngrams(old.title)); "
+        f"INSERT INTO {table}_fts (rowid, terms) VALUES (new.id, schedule_ngrams(new.title)); END",
+    ]
+
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    # 全文索引的触发器调用 schedule_ngrams，写入 schedule 表的每个 SQLite 连接都需要注册
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('schedule_ngrams', 1, index_terms, deterministic=True)
+
+def add_search_index(conn, table='schedule'):
+    if conn.dialect.name == 'sqlite':
+        for statement in sqlite_search_ddl(table):
+            conn.execute(text(statement))
+        conn.execute(text(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('delete-all')"))
+        conn.execute(text(f'INSERT INTO {table}_fts (rowid, terms) SELECT id, schedule_ngrams(title) FROM {table}'))
+    elif conn.dialect.name == 'postgresql':
+        # pg_trgm 的 GIN 索引支持 ILIKE；数据库需使用 UTF-8 编码和非 C 的 locale，汉字才会计入三元组
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table}_title_trgm ON {table} USING gin (title gin_trgm_ops)'))
 
-with app.app_context():
+USAGE_FIELDS = ('title', 'date', 'start_time', 'end_time', 'recur_freq')
+
+def add_usage(deltas, owner, schedule, sign):
+    """把一条单次日程的占用时间计入（sign=1）或移出（sign=-1）deltas；schedule 为含 USAGE_FIELDS 的映射"""
+    if schedule['recur_freq']:
+        return
+    hourly, titles = deltas
+    start = schedule['start_time'].hour * 60 + schedule['start_time'].minute
+    end = schedule['end_time'].hour * 60 + schedule['end_time'].minute
+    for hour in range(start // 60, (end - 1) // 60 + 1):
+        entry = hourly.setdefault((owner, schedule['date'], hour), [0, 0])
+        entry[0] += sign * (min(end, hour * 60 + 60) - max(start, hour * 60))
+    hourly[(owner, schedule['date'], start // 60)][1] += sign
+    entry = titles.setdefault((owner, schedule['title']), [0, 0])
+    entry[0] += sign * (end - start)
+    entry[1] += sign
+
+def track_usage(schedule, sign, owner=None):
+    # 累计到本事务提交时写入的用时汇总，见 write_pending_usage
+    values = {field: getattr(schedule, field) for field in USAGE_FIELDS} if isinstance(schedule, Schedule) else schedule
+    deltas = db.session.info.setdefault('usage', ({}, {}))
+    add_usage(deltas, g.owner_id if owner is None else owner, values, sign)
+
+def upsert_counters(conn, table, keys, counters, rows):
+    # 按主键累加计数；没有原子 upsert 的数据库逐行先更新再插入
+    if not rows:
+        return
+    if conn.dialect.name in ('sqlite', 'postgresql'):
+        insert = (sqlite if conn.dialect.name == 'sqlite' else postgresql).insert(table)
+        conn.execute(insert.on_conflict_do_update(
+            index_elements=keys, set_={name: table.c[name] + insert.excluded[name] for name in counters}), rows)
+        return
+    for row in rows:
+        match = db.and_(*(table.c[key] == row[key] for key in keys))
+        updated = conn.execute(table.update().where(match).values(
+            {name: table.c[name] + row[name] for name in counters}))
+        if not updated.rowcount:
+            conn.execute(table.insert(), row)
+
+def write_usage(conn, deltas):
+    hourly, titles = deltas
+    upsert_counters(conn, HourlyUsage.__table__, ('owner_id', 'date', 'hour'), ('minutes', 'starts'), [
+        {'owner_id': owner, 'date': date, 'hour': hour, 'minutes': booked, 'starts': starts}
+        for (owner, date, hour), (booked, starts) in hourly.items() if booked or starts])
+    upsert_counters(conn, TitleUsage.__table__, ('owner_id', 'title'), ('minutes', 'count'), [
+        {'owner_id': owner, 'title': title, 'minutes': booked, 'count': count}
+        for (owner, title), (booked, count) in titles.items() if booked or count])
+
+def rebuild_usage(conn):
+    """按 schedule 表和归档表重新计算全部用时汇总；归档只是移动行，已归档的日程仍计入统计"""
+    conn.execute(HourlyUsage.__table__.delete())
+    conn.execute(TitleUsage.__table__.delete())
+    deltas = ({}, {})
+    for table in (Schedule.__table__, ArchivedSchedule.__table__):
+        rows = conn.execution_options(stream_results=True).execute(
+            db.select([table.c.owner_id] + [table.c[field] for field in USAGE_FIELDS])
+            .where(table.c.recur_freq.is_(None)))
+        for row in rows:
+            add_usage(deltas, row.owner_id, row._mapping, 1)
+    write_usage(conn, deltas)
+
+def add_usage_stats(conn):
+    # 汇总表由 create_all 创建，这里按已有日程回填
+    rebuild_usage(conn)
+
+def add_archive(conn):
+    # 归档表由 create_all 创建；SQLite 的日程表重建为 AUTOINCREMENT，新日程不会重用已移入归档表的 id
+    if conn.dialect.name == 'sqlite':
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'schedule'")).scalar()
+        if 'AUTOINCREMENT' not in sql.upper():
+            # 改名后触发器随旧表一起删除，索引先删除以便新表使用相同的名称
+            conn.execute(text('ALTER TABLE schedule RENAME TO schedule_old'))
+            for index in inspect(conn).get_indexes('schedule_old'):
+                conn.execute(text(f"DROP INDEX {index['name']}"))
+            Schedule.__table__.create(conn)
+            columns = ', '.join(column.name for column in Schedule.__table__.columns)
+            conn.execute(text(f'INSERT INTO schedule ({columns}) SELECT {columns} FROM schedule_old'))
+            conn.execute(text('DROP TABLE schedule_old'))
+            for statement in sqlite_search_ddl('schedule')[1:]:
+                conn.execute(text(statement))
+    add_search_index(conn, 'schedule_archive')
+
+# 按顺序执行的数据库迁移，执行完第 n 项后 schema_version 为 n
+MIGRATIONS = [add_remind_at, add_change_seq, use_native_time_types, add_recurrence, add_owner, add_search_index,
+              add_usage_stats, add_archive]
+
+def upgrade_schema():
+    fresh = not inspect(db.engine).has_table('schedule')
     db.create_all()
+    version = db.session.query(SchemaVersion.version).scalar()
+    if version is None:
+        # 新建的库已是最新结构
+        version = len(MIGRATIONS) if fresh else 0
+        db.session.add(SchemaVersion(version=version))
+        db.session.commit()
+        if fresh:
+            # create_all 不会创建全文索引
+            with db.engine.begin() as conn:
+                add_search_index(conn)
+                add_search_index(conn, 'schedule_archive')
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with db.engine.begin() as conn:
+            migration(conn)
+            conn.execute(SchemaVersion.__table__.update().values(version=number))
+    if version < len(MIGRATIONS):
+        # create_all 不会为已存在的表补建索引
+        for table in (Schedule.__table__, ArchivedSchedule.__table__, Tombstone.__table__, TitleUsage.__table__):
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+
+    if ChangeCounter.query.get('schedule') is None:
+        seq = max(db.session.query(db.func.max(Schedule.seq)).scalar() or 0,
+                  db.session.query(db.func.max(Tombstone.seq)).scalar() or 0)
+        db.session.add(ChangeCounter(name='schedule', value=seq))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 同时运行的另一个 flask migrate 已经初始化
+            db.session.rollback()
+
+def counter_name(owner):
+    # 匿名用户沿用原来的计数器
+    return 'schedule' if owner == ANONYMOUS_OWNER else f'schedule:{owner}'
+
+def next_change_seq():
+    # 在当前事务内递增当前用户的变更计数器；计数器行锁使序号按提交顺序递增
+    ChangeCounter.query.filter_by(name=counter_name(g.owner_id)) \
+        .update({ChangeCounter.value: ChangeCounter.value + 1}, synchronize_session=False)
+    db.session.info.setdefault('changed', set()).add(g.owner_id)
+    return current_change_seq()
+
+def current_change_seq(owner=None):
+    owner = g.owner_id if owner is None else owner
+    return db.session.query(ChangeCounter.value).filter_by(name=counter_name(owner)).scalar()
+
+class ChangeSeqCache:
+    # 短时间缓存各用户的变更序号，未变化的轮询不必查询数据库；本进程提交写入后立即失效
+    def __init__(self, ttl, max_owners):
+        self.ttl = ttl
+        self.max_owners = max_owners
+        self.values = {}
+
+    def get(self):
+        now = time.monotonic()
+        entry = self.values.get(g.owner_id)
+        if entry is None or now - entry[1] >= self.ttl:
+            if len(self.values) >= self.max_owners:
+                self.values.clear()
+            entry = self.values[g.owner_id] = (current_change_seq(), now)
+        return entry[0]
+
+    def invalidate(self, owners):
+        for owner in owners:
+            self.values.pop(owner, None)
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_change_seq(session):
+    owners = session.info.pop('changed', None)
+    if owners:
+        state().change_seq_cache.invalidate(owners)
+
+@event.listens_for(Session, 'before_commit')
+def write_pending_usage(session):
+    # 用时汇总与日程在同一个事务里写入
+    deltas = session.info.pop('usage', None)
+    if deltas:
+        write_usage(session.connection(), deltas)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_change_flag(session):
+    session.info.pop('changed', None)
+    session.info.pop('usage', None)
+
+def cached_get(build, variant=None):
+    # 以变更序号为版本缓存序列化后的响应；build(seq) 生成响应并设置 ETag。
+    # 响应还取决于 URL 以外的值（如默认为今天的日期）时由 variant 给出，计入缓存键
+    cache = state()
+    seq = cache.change_seq_cache.get()
+    key = (g.owner_id, request.full_path, variant)
+    entry = cache.response_cache.get(key, seq)
+    if entry is None:
+        response = current_app.make_response(build(seq))
+        if response.status_code != 200:
+            return response
+        entry = response.get_data(), list(response.headers)
+        cache.response_cache.put(key, seq, *entry)
+    body, headers = entry
+    return current_app.response_class(body, headers=headers).make_conditional(request)
+
+def changes_since(since):
+    # 归档和移回时日程取新的 seq，以内容不变的更新下发
+    upserts = owned_schedules().filter(Schedule.seq > since).all()
+    upserts += owned_schedules(ArchivedSchedule).filter(ArchivedSchedule.seq > since).all()
+    deletes = Tombstone.query.filter(Tombstone.owner_id == g.owner_id, Tombstone.seq > since).all()
+    changes = [dict(schedule.to_dict(), seq=schedule.seq) for schedule in upserts]
+    changes += [{'id': tombstone.id, 'seq': tombstone.seq, 'deleted': True} for tombstone in deletes]
+    changes.sort(key=lambda change: change['seq'])
+    return changes
+
+def wait_for_change(since, timeout):
+    # 只轮询单行计数器，直到有新变更或超时
+    deadline = time.monotonic() + timeout
+    seq = current_change_seq()
+    while seq <= since and time.monotonic() < deadline:
+        db.session.rollback()
+        time.sleep(CHANGE_POLL_INTERVAL)
+        seq = current_change_seq()
+    return seq
+
+def owned_schedules(model=None):
+    # 当前用户的日程；model 为 ArchivedSchedule 时为已归档的日程
+    model = model or Schedule
+    return model.query.filter(model.owner_id == g.owner_id)
+
+def archive_horizon():
+    # 归档表中只有早于该日期的日程
+    return datetime.now().date() - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+def reaches_archive(date_from):
+    # 从 date_from 开始的查询是否需要读取归档表；未给出起始日期时需要
+    return date_from is None or date_from < archive_horizon()
+
+def move_schedules(execute, source, target, ids):
+    # 在调用方的事务中把 ids 对应的行从 source 表移到 target 表，各列原样保留
+    columns = [column.name for column in Schedule.__table__.columns]
+    rows = db.select([getattr(source, name) for name in columns]).where(source.id.in_(ids))
+    execute(target.__table__.insert().from_select(columns, rows))
+    execute(source.__table__.delete().where(source.id.in_(ids)))
+
+def restore_archived(ids):
+    """把当前用户已归档的这些日程移回 schedule 表，之后按普通日程修改或删除；返回移回的 id。
+    在当前事务中执行，请求未提交时随之回滚"""
+    found = [id for (id,) in db.session.query(ArchivedSchedule.id)
+             .filter(ArchivedSchedule.owner_id == g.owner_id, ArchivedSchedule.id.in_(ids))]
+    if found:
+        move_schedules(db.session.execute, ArchivedSchedule, Schedule, found)
+    return found
+
+def renumber_moved(conn, model, ids):
+    # 移动后的行按所属用户取新的变更序号：各 worker 的区间索引和日历快照据此增量同步，
+    # 变更订阅收到内容不变的更新；同一批次中的行在同一事务中递增计数器
+    owners = [owner for (owner,) in conn.execute(db.select([model.owner_id]).where(model.id.in_(ids)).distinct())]
+    counter = ChangeCounter.__table__
+    for owner in sorted(owners):
+        name = counter_name(owner)
+        conn.execute(counter.update().where(counter.c.name == name).values(value=counter.c.value + 1))
+        seq = conn.execute(db.select([counter.c.value]).where(counter.c.name == name)).scalar()
+        conn.execute(model.__table__.update().where(model.owner_id == owner, model.id.in_(ids)).values(seq=seq))
+
+def archive_schedules(before, batch_size=ARCHIVE_BATCH_SIZE):
+    """把所有用户日期早于 before 的单次日程移入归档表，并把不早于 before 的归档日程移回（归档期限调长之后），
+    返回 (移入数, 移回数)。按 id 顺序分批，每批一个短事务，可以在服务运行时执行"""
+    passes = [
+        (Schedule, ArchivedSchedule, and_(Schedule.recur_freq.is_(None), Schedule.date < before)),
+        (ArchivedSchedule, Schedule, ArchivedSchedule.date >= before),
+    ]
+    moved = []
+    for source, target, criterion in passes:
+        count, last = 0, 0
+        while True:
+            with db.engine.begin() as conn:
+                # 锁住选中的行，移动期间不会有并发的修改丢失
+                ids = [id for (id,) in conn.execute(
+                    db.select([source.id]).where(source.id > last, criterion)
+                    .order_by(source.id).limit(batch_size).with_for_update())]
+                if ids:
+                    move_schedules(conn.execute, source, target, ids)
+                    renumber_moved(conn, target, ids)
+            if not ids:
+                break
+            count += len(ids)
+            last = ids[-1]
+        moved.append(count)
+    return tuple(moved)
+
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def token_owner(token):
+    # 令牌对应的用户 id 在进程内缓存 TOKEN_CACHE_TTL 秒，无效令牌同样缓存
+    digest = hash_token(token)
+    now = time.monotonic()
+    token_owners = state().token_owners
+    entry = token_owners.get(digest)
+    if entry is None or now - entry[1] >= TOKEN_CACHE_TTL:
+        if len(token_owners) >= current_app.config['MAX_CACHED_OWNERS']:
+            token_owners.clear()
+        entry = token_owners[digest] = (db.session.query(User.id).filter_by(token_hash=digest).scalar(), now)
+    return entry[0]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    # 只统计请求中执行的查询；流式响应在生成过程中执行的查询不计入
+    if has_request_context() and 'queries' in g:
+        g.queries += 1
+        g.query_time += time.perf_counter() - context.query_start
+
+@bp.before_app_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.queries = 0
+    g.query_time = 0.0
+    config = current_app.config
+    if config['ENABLE_PROFILING'] and (request.headers.get('X-Profile') or random.random() < config['PROFILE_SAMPLE_RATE']):
+        if state().profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+@bp.after_app_request
+def record_request(response):
+    config, metrics = current_app.config, state().metrics
+    if 'profiler' in g:
+        try:
+            g.profiler.disable()
+            directory = config['PROFILE_DIR'] or os.path.join(current_app.instance_path, 'profiles')
+            os.makedirs(directory, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{request.endpoint}-{os.getpid()}.prof"
+            g.profiler.dump_stats(os.path.join(directory, name))
+            response.headers['X-Profile-File'] = name
+        finally:
+            g.pop('profiler')
+            state().profile_lock.release()
+    # 流式响应只统计到开始发送为止
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (request.method, route)
+    metrics.request_count.inc(labels + (response.status_code,))
+    metrics.request_latency.observe(labels, elapsed)
+    metrics.request_queries.observe(labels, g.queries)
+    metrics.request_query_time.observe(labels, g.query_time)
+    size = response.calculate_content_length()
+    if size is not None:
+        metrics.response_size.observe(labels, size)
+    # 长轮询按设计会等待，不按耗时记录
+    slow = elapsed > config['SLOW_REQUEST_SECONDS'] and \
+        not (request.endpoint == 'schedules.get_changes' and request.args.get('wait'))
+    if slow or g.queries > config['MAX_QUERIES_PER_REQUEST']:
+        current_app.logger.warning('Slow request %s %s: %.0f ms, %d queries (%.0f ms in SQL)', request.method,
+                                   loggable_path(), elapsed * 1000, g.queries, g.query_time * 1000)
+    return response
+
+def loggable_path():
+    # 写入日志的 URL：日历订阅等通过 ?token= 传递的访问令牌不能出现在日志中
+    args = [(name, 'REDACTED' if name == 'token' else value) for name, value in request.args.items(multi=True)]
+    return request.path + ('?' + urlencode(args) if args else '')
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(state().metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.before_app_request
+def check_schema():
+    # 每个进程在第一个请求时确认数据库已由 flask migrate 升级；库比代码新（先迁移后滚动发布）时照常处理
+    if state().schema_checked:
+        return None
+    try:
+        version = db.session.query(SchemaVersion.version).scalar()
+    except SQLAlchemyError:
+        db.session.rollback()
+        version = None
+    if version is None or version < len(MIGRATIONS):
+        current_app.logger.error('Database schema is out of date, run "flask migrate"')
+        return jsonify({'error': 'Database schema is out of date'}), 503
+    state().schema_checked = True
+    return None
+
+@bp.before_app_request
+def authenticate():
+    # 令牌放在 Authorization: Bearer 请求头中；日历订阅等无法设置请求头的客户端可用 ?token=
+    if not request.path.startswith('/api/'):
+        return None
+    header = request.headers.get('Authorization', '')
+    token = header[len('Bearer '):] if header.startswith('Bearer ') else request.args.get('token')
+    if token:
+        g.owner_id = token_owner(token)
+        if g.owner_id is None:
+            return jsonify({'error': 'Invalid token'}), 401
+    elif current_app.config['REQUIRE_AUTH']:
+        return jsonify({'error': 'Authentication required'}), 401
+    else:
+        g.owner_id = ANONYMOUS_OWNER
+    return None
+
+@bp.cli.command('create-user')
+@click.argument('name')
+def create_user(name):
+    """创建用户并输出其访问令牌，令牌只显示这一次。"""
+    token = secrets.token_urlsafe(32)
+    user = User(name=name, token_hash=hash_token(token))
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(ChangeCounter(name=counter_name(user.id), value=0))
+    db.session.commit()
+    click.echo(token)
+
+@bp.cli.command('migrate')
+def migrate():
+    """创建或升级数据库表结构，部署新版本时在启动 worker 之前运行一次。"""
+    upgrade_schema()
+    click.echo(f'Database schema at version {len(MIGRATIONS)}')
+
+@bp.cli.command('rebuild-stats')
+def rebuild_stats():
+    """按全部日程重新计算用时统计汇总表。"""
+    with db.engine.begin() as conn:
+        rebuild_usage(conn)
+    click.echo('Usage statistics rebuilt')
+
+@bp.cli.command('archive')
+def archive():
+    """把早于 ARCHIVE_AFTER_DAYS 天前的单次日程移入归档表，可由 cron 每天运行。"""
+    before = archive_horizon()
+    archived, restored = archive_schedules(before)
+    click.echo(f'Archived {archived} schedules before {before.isoformat()}, restored {restored}')
+
+class OwnerCache:
+    # 按用户分别创建的进程内结构，只保留最近使用的 max_owners 个用户
+    def __init__(self, factory, max_owners):
+        self.factory = factory
+        self.max_owners = max_owners
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, owner=None):
+        owner = g.owner_id if owner is None else owner
+        with self.lock:
+            item = self.items.pop(owner, None)
+            if item is None:
+                item = self.factory(owner)
+            self.items[owner] = item
+            while len(self.items) > self.max_owners:
+                self.items.popitem(last=False)
+            return item
+
+def chunked(items, size=BATCH_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def minutes(value):
+    return value.hour * 60 + value.minute
+
+def format_minutes(value):
+    # 一天结束时刻（1440 分钟）显示为 24:00
+    return f'{value // 60:02d}:{value % 60:02d}'
+
+def parse_minutes(value):
+    # format_minutes 的逆运算，接受表示一天结束的 24:00
+    return 24 * 60 if value == '24:00' else minutes(parse_time(value))
+
+class IntervalIndex:
+    # 单个用户的进程内按天区间索引，用于冲突检测和空闲时段查询；每次使用前按变更序号增量同步，各 worker 各自维护
+    # 重复日程不进入按天索引，按查询窗口展开后作为额外区间参与查询；已归档的日程同样不在索引中，
+    # 查询范围早于归档期限时从归档表读出对应日期的日程作为额外区间
+    def __init__(self, owner):
+        self.owner = owner
+        self.index = DayIntervalIndex()
+        self.series = {}
+        self.seq = None
+        self.lock = threading.Lock()
+
+    def apply(self, id, date, start_time, end_time, *recurrence):
+        rule = make_rule(date, *recurrence)
+        if rule is None:
+            self.series.pop(id, None)
+            self.index.add(id, date, minutes(start_time), minutes(end_time))
+        else:
+            self.index.remove(id)
+            self.series[id] = (rule, minutes(start_time), minutes(end_time))
+
+    def remove(self, id):
+        self.index.remove(id)
+        self.series.pop(id, None)
+
+    def sync(self):
+        seq = current_change_seq(self.owner)
+        if self.seq is not None and seq <= self.seq:
+            return
+        query = db.session.query(Schedule.seq, Schedule.id, Schedule.date, Schedule.start_time, Schedule.end_time,
+                                 Schedule.recur_freq, Schedule.recur_interval, Schedule.recur_count,
+                                 Schedule.recur_until, Schedule.recur_exdates).filter(Schedule.owner_id == self.owner)
+        if self.seq is None:
+            for row in query.yield_per(BATCH_CHUNK_SIZE):
+                self.apply(*row[1:])
+        else:
+            changes = query.filter(Schedule.seq > self.seq).all()
+            # 移入归档表的日程从索引中移除，之后由 extra_by_date 按需从归档表读取
+            for model in (Tombstone, ArchivedSchedule):
+                changes += db.session.query(model.seq, model.id) \
+                    .filter(model.owner_id == self.owner, model.seq > self.seq).all()
+            for change in sorted(changes, key=lambda change: change[0]):
+                if len(change) == 2:
+                    self.remove(change[1])
+                else:
+                    self.apply(*change[1:])
+        self.seq = seq
+
+    def extra_by_date(self, date_from, date_to):
+        by_date = {}
+        for id, (rule, start, end) in self.series.items():
+            for date in occurrences(rule, date_from, date_to):
+                by_date.setdefault(date, []).append((start, end, id))
+        if reaches_archive(date_from):
+            archived = db.session.query(ArchivedSchedule.id, ArchivedSchedule.date, ArchivedSchedule.start_time,
+                                        ArchivedSchedule.end_time) \
+                .filter(ArchivedSchedule.owner_id == self.owner, ArchivedSchedule.date >= date_from,
+                        ArchivedSchedule.date <= date_to)
+            for id, date, start_time, end_time in archived:
+                by_date.setdefault(date, []).append((minutes(start_time), minutes(end_time), id))
+        return by_date
+
+    def overlapping(self, date, start_time, end_time, exclude=None):
+        return [id for _, id in self.overlapping_dates((date,), start_time, end_time, exclude)]
+
+    def overlapping_dates(self, dates, start_time, end_time, exclude=None):
+        # 按日期顺序返回各日期上重叠区间的 (日期, id)，dates 须升序；重复日程只在 dates 的跨度内展开一次
+        if not dates:
+            return []
+        with self.lock:
+            self.sync()
+            extra = self.extra_by_date(dates[0], dates[-1])
+            return [(date, id) for date in dates
+                    for id in self.index.overlapping(date, minutes(start_time), minutes(end_time), exclude,
+                                                     extra.get(date, ()))]
+
+    def clusters(self, date):
+        with self.lock:
+            self.sync()
+            return self.index.clusters(date, self.extra_by_date(date, date).get(date, ()))
+
+    def free_slots(self, date_from, date_to, day_start, day_end, duration):
+        with self.lock:
+            self.sync()
+            extra = self.extra_by_date(date_from, date_to)
+            slots = []
+            date = date_from
+            while date <= date_to:
+                free = self.index.free_slots(date, day_start, day_end, duration, extra.get(date, ()))
+                slots += [(date, start, end) for start, end in free]
+                date += timedelta(days=1)
+            return slots
+
+class CalendarSnapshot:
+    # 单个用户的进程内预先生成的 VEVENT 文本，按变更序号增量同步，写入后只重新生成变化的日程。
+    # 已归档日程的文本在第一次有请求读到归档范围时生成，之后随修改和 flask archive 同样增量同步
+    def __init__(self, owner):
+        self.owner = owner
+        self.events = {}
+        self.archived = None
+        self.seq = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def event(schedule, stamp):
+        # 保存日程占据的日期范围用于按窗口筛选，无限重复的日程没有结束日期
+        last = schedule.recur_end if schedule.recur_freq else schedule.date
+        return schedule.date, last, format_event(schedule.to_dict(), stamp)
+
+    def sync(self):
+        seq = current_change_seq(self.owner)
+        if self.seq is not None and seq <= self.seq:
+            return
+        stamp = datetime.utcnow()
+        query = Schedule.query.filter(Schedule.owner_id == self.owner)
+        if self.seq is None:
+            for schedule in query.yield_per(BATCH_CHUNK_SIZE):
+                self.events[schedule.id] = self.event(schedule, stamp)
+        else:
+            # (序号, 日程或被删除的 id, 日程所在的部分)
+            changes = [(schedule.seq, schedule, self.events) for schedule in query.filter(Schedule.seq > self.seq)]
+            archived = ArchivedSchedule.owner_id == self.owner, ArchivedSchedule.seq > self.seq
+            if self.archived is None:
+                changes += [(seq, id, None) for seq, id in
+                            db.session.query(ArchivedSchedule.seq, ArchivedSchedule.id).filter(*archived)]
+            else:
+                changes += [(schedule.seq, schedule, self.archived)
+                            for schedule in ArchivedSchedule.query.filter(*archived)]
+            changes += [(seq, id, None) for seq, id in db.session.query(Tombstone.seq, Tombstone.id)
+                        .filter(Tombstone.owner_id == self.owner, Tombstone.seq > self.seq)]
+            for _, change, part in sorted(changes, key=lambda change: change[0]):
+                # 在日程表和归档表之间移动的日程先从原来所在的部分删除
+                id = change if part is None else change.id
+                self.events.pop(id, None)
+                if self.archived is not None:
+                    self.archived.pop(id, None)
+                if part is not None:
+                    part[id] = self.event(change, stamp)
+        self.seq = seq
+
+    def load_archived(self):
+        # 读到的比 self.seq 新的移动和修改在随后的 sync 中重放，结果相同
+        stamp = datetime.utcnow()
+        self.archived = {schedule.id: self.event(schedule, stamp) for schedule in
+                         ArchivedSchedule.query.filter(ArchivedSchedule.owner_id == self.owner)
+                         .yield_per(BATCH_CHUNK_SIZE)}
+
+    def render(self, date_from=None, date_to=None, include_archived=False):
+        with self.lock:
+            self.sync()
+            if include_archived and self.archived is None:
+                self.load_archived()
+                self.sync()
+            parts = (self.events, self.archived) if include_archived else (self.events,)
+            events = [text for part in parts for first, last, text in part.values()
+                      if (date_to is None or first <= date_to)
+                      and (date_from is None or last is None or last >= date_from)]
+        return ''.join([*calendar_header(current_app.config['CALENDAR_NAME']), *events, *calendar_footer()])
 
-@app.route('/api/schedules', methods=['GET'])
+class RequestMetrics:
+    def __init__(self):
+        self.registry = Registry()
+        self.request_count = self.registry.counter(
+            'http_requests_total', 'Requests handled', ('method', 'route', 'status'))
+        self.request_latency = self.registry.histogram(
+            'http_request_duration_seconds', 'Time until the response is returned to the server', ('method', 'route'))
+        self.response_size = self.registry.histogram(
+            'http_response_size_bytes', 'Size of non-streamed response bodies', ('method', 'route'), SIZE_BUCKETS)
+        self.request_queries = self.registry.histogram(
+            'db_queries_per_request', 'SQL statements executed per request', ('method', 'route'), QUERY_COUNT_BUCKETS)
+        self.request_query_time = self.registry.histogram(
+            'db_query_duration_seconds_per_request', 'Time spent in SQL per request', ('method', 'route'))
+
+class AppState:
+    # 每个应用实例的进程内缓存、索引和指标，保存在 app.extensions['schedules'] 中，同一进程内的多个应用互不影响
+    def __init__(self, config):
+        max_owners = config['MAX_CACHED_OWNERS']
+        # 本进程是否已确认数据库结构是最新的
+        self.schema_checked = False
+        self.change_seq_cache = ChangeSeqCache(config['CHANGE_SEQ_TTL'], max_owners)
+        self.response_cache = ResponseCache(config['RESPONSE_CACHE_BYTES'])
+        self.token_owners = {}
+        self.interval_indexes = OwnerCache(IntervalIndex, max_owners)
+        self.calendar_snapshots = OwnerCache(CalendarSnapshot, max_owners)
+        self.metrics = RequestMetrics()
+        # 同一进程内同时只运行一个 cProfile 分析器
+        self.profile_lock = threading.Lock()
+
+def state():
+    return current_app.extensions['schedules']
+
+def load_schedules(ids):
+    # 按给定 id 顺序取出日程；区间索引可能给出已归档日程的 id，不在 schedule 表中的再到归档表查找
+    by_id = {}
+    for model in (Schedule, ArchivedSchedule):
+        missing = [id for id in ids if id not in by_id]
+        for chunk in chunked(missing):
+            by_id.update((schedule.id, schedule) for schedule in owned_schedules(model).filter(model.id.in_(chunk)))
+    return [by_id[id] for id in ids if id in by_id]
+
+def find_conflicts(fields, exclude=None):
+    # 重复日程检查每一次发生，最多检查到首次日期后 MAX_CONFLICT_DAYS 天
+    rule = make_rule(fields['date'], fields['recur_freq'], fields['recur_interval'], fields['recur_count'],
+                     fields['recur_until'], fields['recur_exdates'])
+    if rule is None:
+        dates = (fields['date'],)
+    else:
+        horizon = fields['date'] + timedelta(days=MAX_CONFLICT_DAYS)
+        dates = occurrences(rule, fields['date'], min(fields['recur_end'] or horizon, horizon))
+    found = state().interval_indexes.get().overlapping_dates(dates, fields['start_time'], fields['end_time'], exclude)
+    schedules = {schedule.id: schedule for schedule in load_schedules(list(dict.fromkeys(id for _, id in found)))}
+    return [schedules[id].occurrence_dict(date) for date, id in found if id in schedules]
+
+def find_writable(id):
+    # 要修改或删除的日程，已归档的先移回 schedule 表
+    schedule = owned_schedules().filter(Schedule.id == id).first()
+    if schedule is None and restore_archived([id]):
+        schedule = owned_schedules().filter(Schedule.id == id).first()
+    if schedule is None:
+        abort(404)
+    return schedule
+
+def version_mismatch(schedule):
+    # 请求头 If-Match 给出的单条日程 ETag 与当前版本不一致时返回 412 响应
+    if request.if_match and not request.if_match.contains(f'{schedule.id}-{schedule.seq}'):
+        return jsonify({'error': 'Schedule was modified', 'schedule': dict(schedule.to_dict(), seq=schedule.seq)}), 412
+    return None
+
+def conflict_mode():
+    mode = request.args.get('conflicts')
+    if mode not in (None, 'reject', 'warn'):
+        raise ValidationError('Invalid conflicts mode')
+    return mode
+
+def recurring_in_window(date_from, date_to, *criteria):
+    # 与窗口相交的重复日程，逐个展开窗口内的发生日期
+    series = owned_schedules().filter(
+        Schedule.recur_freq.isnot(None), Schedule.date <= date_to,
+        db.or_(Schedule.recur_end.is_(None), Schedule.recur_end >= date_from), *criteria)
+    for schedule in series:
+        for date in occurrences(schedule.rule(), date_from, date_to):
+            yield date, schedule
+
+def encode_cursor(key):
+    date, start_time, id = key
+    key = json.dumps([date.isoformat(), start_time.strftime('%H:%M'), id])
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        date, start_time, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return parse_date(date), parse_time(start_time), int(id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+@bp.route('/api/schedules', methods=['GET'])
 def get_schedules():
-    schedules = Schedule.query.order_by(Schedule.date, Schedule.start_time).all()
-    return jsonify([schedule.to_dict() for schedule in schedules])
+    return cached_get(list_schedules)
+
+def list_schedules(seq):
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    try:
+        date_from = parse_date(date_from) if date_from else None
+        date_to = parse_date(date_to) if date_to else None
+    except ValidationError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({'error': f'Limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+
+    try:
+        key = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # 同时给出 from 和 to 时才展开重复日程，否则按存储的原始记录返回
+    expand = date_from is not None and date_to is not None
+
+    # seq 在查询之前读取，客户端从该序号订阅变更不会漏掉并发写入
+    # 范围早于归档期限时同样查询归档表，两个表各自按索引顺序取出后合并
+    rows = []
+    for model in (Schedule, ArchivedSchedule) if reaches_archive(date_from) else (Schedule,):
+        query = owned_schedules(model)
+        if date_from:
+            query = query.filter(model.date >= date_from)
+        if date_to:
+            query = query.filter(model.date <= date_to)
+        if expand:
+            query = query.filter(model.recur_freq.is_(None))
+        if key:
+            query = query.filter(tuple_(model.date, model.start_time, model.id) > key)
+        query = query.order_by(model.date, model.start_time, model.id)
+        if limit is not None:
+            # 多取一行用于判断是否还有下一页
+            query = query.limit(limit + 1)
+        rows += [(schedule.sort_key(), schedule) for schedule in query]
+    if expand:
+        window_from = max(date_from, key[0]) if key else date_from
+        for date, schedule in recurring_in_window(window_from, date_to):
+            row_key = (date, schedule.start_time, schedule.id)
+            if key is None or row_key > key:
+                rows.append((row_key, schedule))
+    rows.sort(key=lambda row: row[0])
+
+    more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    response = jsonify([schedule.occurrence_dict(row_key[0]) for row_key, schedule in rows])
+    if more:
+        response.headers['X-Next-Cursor'] = encode_cursor(rows[-1][0])
+    response.headers['X-Change-Seq'] = str(seq)
+    response.set_etag(str(seq))
+    return response
+
+def encode_search_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor):
+    try:
+        score, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(score), int(id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+def search_matches(model, query, q):
+    """在 model 表上 query 的结果中检索标题，返回全部匹配的 (id, score) 子查询，分数越小越相关；
+    搜索词中没有可检索的字符时返回 None"""
+    match, fragments, tokens = parse_query(q)
+    if match is None:
+        return None
+    # 词元只含字母、数字和汉字，拼入 LIKE 模式不需要转义
+    if db.engine.dialect.name == 'sqlite':
+        fts_name = f'{model.__tablename__}_fts'
+        fts = db.table(fts_name, db.column('rowid', db.Integer))
+        query = query.join(fts, fts.c.rowid == model.id) \
+            .filter(text(f'{fts_name} MATCH :match').bindparams(match=match))
+        for fragment in fragments:
+            query = query.filter(model.title.like(f'%{fragment}%'))
+        score = db.func.bm25(db.literal_column(fts_name))
+    else:
+        for token in tokens:
+            query = query.filter(model.title.ilike(f'%{token}%'))
+        score = -db.func.similarity(model.title, q) if db.engine.dialect.name == 'postgresql' else db.literal(0.0)
+    # 在全部匹配上排序，按 (score, id) 翻页能取到每一条匹配
+    return query.with_entities(model.id.label('id'), score.label('score')).subquery('matches')
 
-@app.route('/api/schedules', methods=['POST'])
+@bp.route('/api/schedules/search', methods=['GET'])
+def search_schedules():
+    return cached_get(search_results)
+
+def search_results(seq):
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'Missing search query'}), 400
+    try:
+        date_from = parse_date(request.args['from']) if request.args.get('from') else None
+        date_to = parse_date(request.args['to']) if request.args.get('to') else None
+    except ValidationError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    try:
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'Limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    try:
+        key = decode_search_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # 按日程本身（重复日程为整个系列）是否与 [from, to] 相交过滤，不展开重复日程；范围早于归档期限时同样检索归档表
+    rows = []
+    for model in (Schedule, ArchivedSchedule) if reaches_archive(date_from) else (Schedule,):
+        query = owned_schedules(model)
+        if date_from:
+            query = query.filter(or_(model.date >= date_from, and_(
+                model.recur_freq.isnot(None), or_(model.recur_end.is_(None), model.recur_end >= date_from))))
+        if date_to:
+            query = query.filter(model.date <= date_to)
+        matches = search_matches(model, query, q)
+        if matches is None:
+            break
+        query = model.query.join(matches, matches.c.id == model.id)
+        score = matches.c.score
+        if key:
+            query = query.filter(tuple_(score, model.id) > key)
+        rows += query.add_columns(score).order_by(score, model.id).limit(limit + 1).all()
+    rows.sort(key=lambda row: (row[1], row[0].id))
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    response = jsonify([schedule.to_dict() for schedule, _ in rows])
+    if more:
+        schedule, score = rows[-1]
+        response.headers['X-Next-Cursor'] = encode_search_cursor((score, schedule.id))
+    response.headers['X-Change-Seq'] = str(seq)
+    response.set_etag(str(seq))
+    return response
+
+@bp.route('/api/schedules', methods=['POST'])
 def add_schedule():
-    data = request.json
-    try:
-        # 验证日期和时间格式
-        datetime.strptime(data['date'], '%Y-%m-%d')
-        datetime.strptime(data['start_time'], '%H:%M')
-        datetime.strptime(data['end_time'], '%H:%M')
-        if 'reminder_time' in data and data['reminder_time']:
-            datetime.strptime(data['reminder_time'], '%H:%M')
-        
-        # 检查时间顺序
-        start_dt = datetime.strptime(f"{data['date']} {data['start_time']}", '%Y-%m-%d %H:%M')
-        end_dt = datetime.strptime(f"{data['date']} {data['end_time']}", '%Y-%m-%d %H:%M')
-        if end_dt <= start_dt:
-            return jsonify({'error': 'End time must be later than start time'}), 400
-            
-        schedule = Schedule(
-            title=data['title'],
-            date=data['date'],
-            start_time=data['start_time'],
-            end_time=data['end_time'],
-            reminder_time=data.get('reminder_time')
-        )
+    try:
+        mode = conflict_mode()
+        fields = parse_schedule(request.json)
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    conflicts = find_conflicts(fields) if mode else []
+    if conflicts and mode == 'reject':
+        return jsonify({'error': 'Schedule overlaps existing schedules', 'conflicts': conflicts}), 409
+    try:
+        schedule = Schedule(owner_id=g.owner_id, seq=next_change_seq(), **fields)
         db.session.add(schedule)
+        track_usage(fields, 1)
         db.session.commit()
-        return jsonify(schedule.to_dict()), 201
-    except ValueError:
-        return jsonify({'error': 'Invalid date or time format'}), 400
+        result = schedule.to_dict()
+        if mode == 'warn':
+            result['conflicts'] = conflicts
+        return jsonify(result), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-@app.route('/api/schedules/<int:id>', methods=['PUT'])
+@bp.route('/api/schedules/<int:id>', methods=['PUT'])
 def update_schedule(id):
-    schedule = Schedule.query.get_or_404(id)
-    data = request.json
-    try:
-        # 验证日期和时间格式
-        datetime.strptime(data['date'], '%Y-%m-%d')
-        datetime.strptime(data['start_time'], '%H:%M')
-        datetime.strptime(data['end_time'], '%H:%M')
-        if 'reminder_time' in data and data['reminder_time']:
-            datetime.strptime(data['reminder_time'], '%H:%M')
-        
-        # 检查时间顺序
-        start_dt = datetime.strptime(f"{data['date']} {data['start_time']}", '%Y-%m-%d %H:%M')
-        end_dt = datetime.strptime(f"{data['date']} {data['end_time']}", '%Y-%m-%d %H:%M')
-        if end_dt <= start_dt:
-            return jsonify({'error': 'End time must be later than start time'}), 400
-            
-        schedule.title = data['title']
-        schedule.date = data['date']
-        schedule.start_time = data['start_time']
-        schedule.end_time = data['end_time']
-        schedule.reminder_time = data.get('reminder_time')
+    schedule = find_writable(id)
+    mismatch = version_mismatch(schedule)
+    if mismatch:
+        return mismatch
+    try:
+        mode = conflict_mode()
+        fields = parse_schedule(request.json)
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    conflicts = find_conflicts(fields, exclude=id) if mode else []
+    if conflicts and mode == 'reject':
+        return jsonify({'error': 'Schedule overlaps existing schedules', 'conflicts': conflicts}), 409
+    try:
+        track_usage(schedule, -1)
+        for field, value in fields.items():
+            setattr(schedule, field, value)
+        track_usage(schedule, 1)
+        schedule.seq = next_change_seq()
         db.session.commit()
-        return jsonify(schedule.to_dict())
-    except ValueError:
-        return jsonify({'error': 'Invalid date or time format'}), 400
+        result = schedule.to_dict()
+        if mode == 'warn':
+            result['conflicts'] = conflicts
+        return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-@app.route('/api/schedules/<int:id>', methods=['DELETE'])
+def insert_schedules(rows, seq):
+    # 批量插入新日程并把 id 写回 rows。PostgreSQL 用 INSERT ... RETURNING，每块一条语句；
+    # 其它数据库 executemany 插入后按 (owner_id, seq) 读回：本批新行独占这个序号，id 按插入顺序递增
+    if not rows:
+        return
+    table = Schedule.__table__
+    if db.engine.dialect.name == 'postgresql':
+        for chunk in chunked(rows):
+            ids = db.session.execute(table.insert().values(chunk).returning(table.c.id)).scalars()
+            for row, id in zip(chunk, ids):
+                row['id'] = id
+        return
+    db.session.execute(table.insert(), rows)
+    ids = db.session.query(Schedule.id).filter(Schedule.owner_id == g.owner_id, Schedule.seq == seq) \
+        .order_by(Schedule.id)
+    for row, (id,) in zip(rows, ids):
+        row['id'] = id
+
+@bp.route('/api/schedules/batch', methods=['POST'])
+def batch_schedules():
+    operations = request.json
+    if not isinstance(operations, list):
+        return jsonify({'error': 'Request body must be an array of operations'}), 400
+    if len(operations) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} operations per batch'}), 400
+    if not operations:
+        # 空批次不写入，也不递增变更序号
+        return jsonify({'seq': current_change_seq(), 'results': []})
+
+    # 第一遍：校验全部操作，任何一项失败则整批不写入
+    results = [None] * len(operations)
+    creates, updates, deletes = [], [], []
+    seen_ids = set()
+    writes = [i for i, operation in enumerate(operations)
+              if isinstance(operation, dict) and operation.get('op') in ('create', 'update')]
+    parsed, errors = parse_schedules([operations[i].get('data') for i in writes])
+    fields_by_index = dict(zip(writes, parsed))
+    errors_by_index = dict(zip(writes, errors))
+    for i, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        if op not in ('create', 'update', 'delete'):
+            results[i] = {'status': 400, 'error': 'Unknown operation'}
+            continue
+        if op != 'create':
+            id = operation.get('id')
+            if not isinstance(id, int):
+                results[i] = {'status': 400, 'error': 'Missing or invalid id'}
+                continue
+            if id in seen_ids:
+                results[i] = {'status': 400, 'error': 'Duplicate id in batch'}
+                continue
+            seen_ids.add(id)
+            base_seq = operation.get('base_seq')
+            if base_seq is not None and not isinstance(base_seq, int):
+                results[i] = {'status': 400, 'error': 'Invalid base_seq'}
+                continue
+        if op != 'delete' and errors_by_index[i]:
+            results[i] = {'status': 400, 'error': errors_by_index[i]}
+            continue
+        if op == 'create':
+            creates.append((i, fields_by_index[i]))
+        elif op == 'update':
+            updates.append((i, dict(fields_by_index[i], id=operation['id'])))
+        else:
+            deletes.append((i, operation['id']))
+
+    # 带 base_seq 的更新和删除只在日程自该序号后未被修改时执行，否则返回 412
+    existing, previous = {}, {}
+    def load_existing(ids):
+        for row in db.session.query(Schedule.id, Schedule.seq, *(getattr(Schedule, field) for field in USAGE_FIELDS)) \
+                .filter(Schedule.owner_id == g.owner_id, Schedule.id.in_(ids)):
+            existing[row.id] = row.seq
+            # 修改前的字段，用于从用时汇总中扣除
+            previous[row.id] = row._mapping
+    for ids in chunked(sorted(seen_ids)):
+        load_existing(ids)
+    # 已归档的日程先移回 schedule 表；整批失败时随事务回滚
+    for ids in chunked(sorted(seen_ids - existing.keys())):
+        restored = restore_archived(ids)
+        if restored:
+            load_existing(restored)
+    for i, id in [(i, row['id']) for i, row in updates] + deletes:
+        base_seq = operations[i].get('base_seq')
+        if id not in existing:
+            results[i] = {'status': 404, 'error': 'Schedule not found'}
+        elif base_seq is not None and existing[id] > base_seq:
+            results[i] = {'status': 412, 'error': 'Schedule was modified', 'seq': existing[id]}
+
+    if any(results):
+        # 424：该项本身合法，但因同批其它操作失败而未执行
+        results = [result or {'status': 424, 'error': 'Not applied'} for result in results]
+        return jsonify({'results': results}), 400
+
+    # 第二遍：整批共用一个变更序号，在同一个事务里批量写入
+    seq = next_change_seq()
+    try:
+        rows = [dict(row, owner_id=g.owner_id, seq=seq) for _, row in creates]
+        insert_schedules(rows, seq)
+        db.session.bulk_update_mappings(Schedule, [dict(row, seq=seq) for _, row in updates])
+        delete_ids = [id for _, id in deletes]
+        for row in rows:
+            track_usage(row, 1)
+        for _, row in updates:
+            track_usage(previous[row['id']], -1)
+            track_usage(row, 1)
+        for id in delete_ids:
+            track_usage(previous[id], -1)
+        for ids in chunked(delete_ids):
+            Schedule.query.filter(Schedule.id.in_(ids)).delete(synchronize_session=False)
+            Tombstone.query.filter(Tombstone.id.in_(ids)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(Tombstone, [{'id': id, 'owner_id': g.owner_id, 'seq': seq}
+                                                    for id in delete_ids])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+    for (i, _), row in zip(creates, rows):
+        results[i] = {'status': 201, 'schedule': Schedule(**row).to_dict()}
+    for i, row in updates:
+        results[i] = {'status': 200, 'schedule': Schedule(**row).to_dict()}
+    for i, id in deletes:
+        results[i] = {'status': 204, 'id': id}
+    return jsonify({'seq': seq, 'results': results})
+
+@bp.route('/api/schedules/export', methods=['GET'])
+def export_schedules():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'ics'):
+        return jsonify({'error': 'Format must be ndjson or ics'}), 400
+    # 服务端游标分批读取日程表和归档表并按顺序合并，内存占用与总行数无关
+    query = heapq.merge(*(owned_schedules(model).order_by(model.date, model.start_time, model.id)
+                          .execution_options(stream_results=True).yield_per(EXPORT_CHUNK_SIZE)
+                          for model in (Schedule, ArchivedSchedule)), key=ScheduleColumns.sort_key)
+    if export_format == 'ics':
+        body, mimetype = export_ics(query), 'text/calendar'
+    else:
+        body = (json.dumps(schedule.to_dict(), ensure_ascii=False) + '\n' for schedule in query)
+        mimetype = 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=schedules.{export_format}'})
+
+def export_ics(query):
+    stamp = datetime.utcnow()
+    yield from calendar_header()
+    for schedule in query:
+        yield format_event(schedule.to_dict(), stamp)
+    yield from calendar_footer()
+
+def request_lines():
+    # 按块读取请求体再切成行，不逐行调用 readline：ASGI 部署下 a2wsgi 的 readline 在缓冲区为空时
+    # 不等待后续数据而返回空串，werkzeug 会把它当作客户端断开
+    pending = b''
+    while True:
+        chunk = request.stream.read(IMPORT_READ_SIZE)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+def json_item(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise ValidationError('Invalid JSON')
+
+def insert_chunk(rows):
+    # 每块一个事务、一个变更序号
+    seq = next_change_seq()
+    db.session.bulk_insert_mappings(Schedule, [dict(row, owner_id=g.owner_id, seq=seq) for row in rows])
+    for row in rows:
+        track_usage(row, 1)
+    db.session.commit()
+    return seq
+
+@bp.route('/api/schedules/import', methods=['POST'])
+def import_schedules():
+    # 按行读取请求体，逐条校验，每 IMPORT_CHUNK_SIZE 条提交一次；不合法的条目跳过并报告
+    if request.mimetype == 'text/calendar' or request.args.get('format') == 'ics':
+        items, convert = enumerate(iter_events(request_lines()), 1), event_to_schedule
+    else:
+        items, convert = ((number, line) for number, line in enumerate(request_lines(), 1) if line.strip()), json_item
+
+    imported, skipped, errors, rows, seq = 0, 0, [], [], None
+    try:
+        for number, item in items:
+            try:
+                rows.append(parse_schedule(convert(item)))
+            except ValidationError as e:
+                skipped += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({'item': number, 'error': str(e)})
+                continue
+            if len(rows) >= IMPORT_CHUNK_SIZE:
+                seq = insert_chunk(rows)
+                imported += len(rows)
+                rows = []
+        if rows:
+            seq = insert_chunk(rows)
+            imported += len(rows)
+    except ValidationError as e:
+        # 日历结构损坏时无法继续解析，已提交的块保留
+        return jsonify({'error': str(e), 'imported': imported, 'seq': seq}), 400
+    return jsonify({'imported': imported, 'skipped': skipped, 'errors': errors, 'seq': seq})
+
+@bp.route('/api/schedules/<int:id>', methods=['DELETE'])
 def delete_schedule(id):
-    schedule = Schedule.query.get_or_404(id)
+    schedule = find_writable(id)
+    mismatch = version_mismatch(schedule)
+    if mismatch:
+        return mismatch
     db.session.delete(schedule)
+    track_usage(schedule, -1)
+    db.session.merge(Tombstone(id=schedule.id, owner_id=g.owner_id, seq=next_change_seq()))
     db.session.commit()
     return '', 204
 
-@app.route('/api/schedules/<int:id>', methods=['GET'])
+@bp.route('/api/schedules/conflicts', methods=['GET'])
+def get_conflicts():
+    try:
+        date = parse_date(request.args.get('date'))
+        start_time = request.args.get('start')
+        end_time = request.args.get('end')
+        if start_time or end_time:
+            start_time, end_time = parse_time(start_time), parse_time(end_time)
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if start_time:
+        # 与给定时间段重叠的日程
+        ids = state().interval_indexes.get().overlapping(date, start_time, end_time)
+        return jsonify([schedule.occurrence_dict(date) for schedule in load_schedules(ids)])
+    # 当天互相重叠的日程分组
+    groups = state().interval_indexes.get().clusters(date)
+    schedules = {schedule.id: schedule.occurrence_dict(date)
+                 for schedule in load_schedules([id for group in groups for id in group])}
+    return jsonify([[schedules[id] for id in group if id in schedules] for group in groups])
+
+@bp.route('/api/free-slots', methods=['GET'])
+def get_free_slots():
+    try:
+        date_from = parse_date(request.args.get('from'))
+        date_to = parse_date(request.args.get('to'))
+        day_start = minutes(parse_time(request.args.get('day_start', '00:00')))
+        day_end = parse_minutes(request.args.get('day_end', '24:00'))
+        duration = int(request.args.get('duration', ''))
+    except (ValidationError, ValueError):
+        return jsonify({'error': 'Invalid from, to, day_start, day_end or duration'}), 400
+    if date_to < date_from or (date_to - date_from).days >= MAX_FREE_SLOT_DAYS:
+        return jsonify({'error': f'Date range must be between 1 and {MAX_FREE_SLOT_DAYS} days'}), 400
+    if duration <= 0 or day_end <= day_start:
+        return jsonify({'error': 'Duration and day range must be positive'}), 400
+
+    slots = state().interval_indexes.get().free_slots(date_from, date_to, day_start, day_end, duration)
+    return jsonify([{
+        'date': date.isoformat(),
+        'start_time': format_minutes(start),
+        'end_time': format_minutes(end),
+        'minutes': end - start
+    } for date, start, end in slots])
+
+def day_of_week(column):
+    # 星期几，星期日为 0
+    if db.engine.dialect.name == 'sqlite':
+        return db.cast(db.func.strftime('%w', column), db.Integer)
+    return db.extract('dow', column)
+
+@bp.route('/api/stats', methods=['GET'])
+def get_stats():
+    try:
+        date_to = parse_date(request.args['to']) if request.args.get('to') else datetime.now().date()
+        date_from = parse_date(request.args['from']) if request.args.get('from') else date_to - timedelta(days=29)
+    except ValidationError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    if date_to < date_from or (date_to - date_from).days >= MAX_STATS_DAYS:
+        return jsonify({'error': f'Date range must be between 1 and {MAX_STATS_DAYS} days'}), 400
+    # 未给出 to 时窗口随日期推移，解析后的窗口计入缓存键和 ETag
+    return cached_get(lambda seq: build_stats(seq, date_from, date_to), variant=(date_from, date_to))
+
+def build_stats(seq, date_from, date_to):
+    # 从按小时汇总的表读取，代价与窗口内的天数成正比，与日程数无关
+    window = (HourlyUsage.owner_id == g.owner_id, HourlyUsage.date >= date_from, HourlyUsage.date <= date_to)
+    daily = db.session.query(HourlyUsage.date, db.func.sum(HourlyUsage.minutes), db.func.sum(HourlyUsage.starts)) \
+        .filter(*window).group_by(HourlyUsage.date)
+    weekday = day_of_week(HourlyUsage.date)
+    by_hour = db.session.query(weekday, HourlyUsage.hour, db.func.sum(HourlyUsage.minutes)) \
+        .filter(*window).group_by(weekday, HourlyUsage.hour)
+    heatmap = [[0] * 24 for _ in range(7)]
+    for dow, hour, booked in by_hour:
+        # 数据库中星期日为 0，输出以星期一为 0
+        heatmap[(int(dow) + 6) % 7][int(hour)] += booked
+    days = {date: [booked, starts] for date, booked, starts in daily}
+
+    # 重复日程不在汇总表中，展开窗口内的发生后按同样方式计入
+    deltas = ({}, {})
+    for date, schedule in recurring_in_window(date_from, date_to):
+        values = {field: getattr(schedule, field) for field in USAGE_FIELDS}
+        add_usage(deltas, g.owner_id, dict(values, date=date, recur_freq=None), 1)
+    for (_, date, hour), (booked, starts) in deltas[0].items():
+        entry = days.setdefault(date, [0, 0])
+        entry[0] += booked
+        entry[1] += starts
+        heatmap[date.weekday()][hour] += booked
+
+    weeks = {}
+    for date, (booked, starts) in days.items():
+        entry = weeks.setdefault(date - timedelta(days=date.weekday()), [0, 0])
+        entry[0] += booked
+        entry[1] += starts
+    titles = TitleUsage.query.filter(TitleUsage.owner_id == g.owner_id, TitleUsage.count > 0) \
+        .order_by(TitleUsage.minutes.desc(), TitleUsage.title.desc()).limit(STATS_TOP_TITLES)
+
+    response = jsonify({
+        'from': date_from.isoformat(),
+        'to': date_to.isoformat(),
+        'total_minutes': sum(booked for booked, _ in days.values()),
+        'count': sum(count for _, count in days.values()),
+        'days': [{'date': date.isoformat(), 'minutes': booked, 'count': count}
+                 for date, (booked, count) in sorted(days.items()) if booked or count],
+        'weeks': [{'week': week.isoformat(), 'minutes': booked, 'count': count}
+                  for week, (booked, count) in sorted(weeks.items()) if booked or count],
+        # heatmap[星期][小时]，星期一为 0
+        'heatmap': heatmap,
+        # 按标题的统计不限日期，不含重复日程
+        'titles': [{'title': usage.title, 'minutes': usage.minutes, 'count': usage.count} for usage in titles],
+    })
+    response.set_etag(f'{seq}-{date_from.isoformat()}-{date_to.isoformat()}')
+    return response
+
+@bp.route('/api/schedules/<int:id>', methods=['GET'])
 def get_schedule(id):
-    schedule = Schedule.query.get_or_404(id)
-    return jsonify(schedule.to_dict())
+    def build(seq):
+        schedule = owned_schedules().filter(Schedule.id == id).first() \
+            or owned_schedules(ArchivedSchedule).filter(ArchivedSchedule.id == id).first_or_404()
+        response = jsonify(schedule.to_dict())
+        # 单条日程的 ETag 取该行的版本号
+        response.set_etag(f'{schedule.id}-{schedule.seq}')
+        return response
+    return cached_get(build)
+
+@bp.route('/api/changes', methods=['GET'])
+def get_changes():
+    # EventSource 重连时带上最后收到的事件 id，比最初连接 URL 中的 since 更新
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', '0')
+    try:
+        since = int(since)
+        wait = min(float(request.args.get('wait', 0)), MAX_CHANGE_WAIT)
+    except ValueError:
+        return jsonify({'error': 'Invalid since or wait'}), 400
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return Response(stream_with_context(stream_changes(since)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    # 长轮询：wait>0 时阻塞到有变更或超时
+    seq = wait_for_change(since, wait) if wait > 0 else current_change_seq()
+    changes = changes_since(since) if seq > since else []
+    return jsonify({'seq': seq, 'changes': changes})
+
+def stream_changes(since):
+    yield 'retry: 3000\n\n'
+    deadline = time.monotonic() + SSE_MAX_DURATION
+    while time.monotonic() < deadline:
+        seq = wait_for_change(since, SSE_KEEPALIVE)
+        if seq <= since:
+            yield ': keepalive\n\n'
+            continue
+        # 计数器读取之后提交的变更也会一并发出，since 取实际发出的最大序号，避免下一轮重发
+        for change in changes_since(since):
+            yield f"id: {change['seq']}\ndata: {json.dumps(change, ensure_ascii=False)}\n\n"
+            seq = max(seq, change['seq'])
+        since = seq
+        db.session.rollback()
+
+@bp.route('/api/calendar.ics', methods=['GET'])
+def get_calendar():
+    def build(seq):
+        try:
+            date_from = parse_date(request.args['from']) if request.args.get('from') else None
+            date_to = parse_date(request.args['to']) if request.args.get('to') else None
+        except ValidationError:
+            return jsonify({'error': 'Invalid date format'}), 400
+        body = state().calendar_snapshots.get().render(date_from, date_to, reaches_archive(date_from))
+        response = current_app.response_class(body, mimetype='text/calendar')
+        response.set_etag(str(seq))
+        return response
+    # 日历客户端定期轮询，未变化时直接返回缓存的响应
+    return cached_get(build)
+
+@bp.route('/api/reminders/due', methods=['GET'])
+def get_due_reminders():
+    # 提醒时间是用户本地的钟点，"到期"应按客户端的当前时间判断；未携带 now 时退回服务器时间
+    now = request.args.get('now')
+    try:
+        now = parse_datetime(now) if now else datetime.now()
+    except ValidationError:
+        return jsonify({'error': 'Invalid now format'}), 400
+    until = now.replace(second=0, microsecond=0)
+    since = request.args.get('since')
+    try:
+        since = parse_datetime(since) if since else until - timedelta(minutes=1)
+    except ValidationError:
+        return jsonify({'error': 'Invalid since format'}), 400
+    since = max(since, until - MAX_REMINDER_LOOKBACK)
+
+    # 单次日程只通过 remind_at 索引读取 (since, until] 区间内到期的提醒
+    due = [(schedule.remind_at, schedule.id, schedule.to_dict()) for schedule in
+           owned_schedules().filter(Schedule.remind_at > since, Schedule.remind_at <= until)]
+    upcoming = db.session.query(Schedule.remind_at) \
+        .filter(Schedule.owner_id == g.owner_id, Schedule.remind_at > until) \
+        .order_by(Schedule.remind_at).limit(1).scalar()
+
+    # 重复日程按发生日期展开到期窗口和之后几天，找出到期和下一个提醒
+    horizon = until.date() + timedelta(days=REMINDER_HORIZON_DAYS)
+    for date, schedule in recurring_in_window(since.date(), horizon, Schedule.reminder_time.isnot(None)):
+        remind_at = datetime.combine(date, schedule.reminder_time)
+        if since < remind_at <= until:
+            due.append((remind_at, schedule.id, schedule.occurrence_dict(date)))
+        elif remind_at > until and (upcoming is None or remind_at < upcoming):
+            upcoming = remind_at
+    due.sort(key=lambda item: item[:2])
+
+    next_due_in = None
+    if upcoming:
+        next_due_in = max(0, int((upcoming - now).total_seconds()))
+    return jsonify({
+        'since': since.strftime('%Y-%m-%d %H:%M'),
+        'until': until.strftime('%Y-%m-%d %H:%M'),
+        'next_due': upcoming.strftime('%Y-%m-%d %H:%M') if upcoming else None,
+        'next_due_in': next_due_in,
+        'reminders': [schedule for _, _, schedule in due]
+    })
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000))) 
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000))) 
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""ASGI 入口：gunicorn 'asgi:create_app()' -k uvicorn.workers.UvicornWorker
+
+普通请求交给线程池中的 Flask 应用处理，行为与 WSGI 部署完全相同。占用时间
+长的 /api/changes 长轮询和 Server-Sent Events 在事件循环中等待：每个进程只有
+一个后台任务按 CHANGE_POLL_INTERVAL 批量读取有等待者的用户的变更计数器并唤醒
+对应的连接，等待中的客户端不占用线程或数据库连接，少量进程即可保持数千个
+连接。有新变更时查询和序列化仍由 app.py 中的同一份代码完成。
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qsl, urlencode
+
+from a2wsgi import WSGIMiddleware
+from flask import g
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from app import (ANONYMOUS_OWNER, CHANGE_POLL_INTERVAL, MAX_CHANGE_WAIT, SSE_KEEPALIVE, SSE_MAX_DURATION,
+                 ChangeCounter, changes_since, counter_name, create_app as create_flask_app, db, token_owner)
+
+# 鉴权、读取计数器和变更等短查询使用的线程数
+DB_THREADS = 2
+
+
+def read_change_seqs(owners):
+    rows = db.session.query(ChangeCounter.name, ChangeCounter.value) \
+        .filter(ChangeCounter.name.in_([counter_name(owner) for owner in owners]))
+    values = dict(rows)
+    return {owner: values.get(counter_name(owner)) or 0 for owner in owners}
+
+
+class ChangeNotifier:
+    """按用户等待变更序号超过给定值"""
+
+    def __init__(self, app):
+        self.app = app
+        self.seqs = {}
+        self.waiters = {}
+        self.task = None
+
+    async def wait(self, owner, since, timeout):
+        loop = asyncio.get_running_loop()
+        if owner not in self.waiters:
+            # 没有其它等待者时缓存的序号可能已过时
+            self.seqs.update(await self.app.run_in_app(read_change_seqs, [owner]))
+        seq = self.seqs[owner]
+        deadline = loop.time() + timeout
+        while seq <= since and loop.time() < deadline:
+            event = asyncio.Event()
+            self.waiters.setdefault(owner, set()).add(event)
+            if self.task is None:
+                self.task = asyncio.ensure_future(self.poll())
+            try:
+                await asyncio.wait_for(event.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                events = self.waiters[owner]
+                events.discard(event)
+                if not events:
+                    del self.waiters[owner]
+            seq = self.seqs[owner]
+        return seq
+
+    async def poll(self):
+        try:
+            while self.waiters:
+                await asyncio.sleep(CHANGE_POLL_INTERVAL)
+                owners = list(self.waiters)
+                try:
+                    seqs = await self.app.run_in_app(read_change_seqs, owners)
+                except Exception:
+                    self.app.flask_app.logger.exception('Failed to read change counters')
+                    continue
+                for owner, seq in seqs.items():
+                    if seq != self.seqs.get(owner):
+                        self.seqs[owner] = seq
+                        for event in self.waiters.get(owner, ()):
+                            event.set()
+        finally:
+            self.task = None
+
+
+class ScheduleApp:
+    def __init__(self, flask_app, threads=4):
+        # threads 为执行 Flask 请求的线程数，与 WSGI 部署时每个 worker 的线程数相同，数据库连接池按此设置大小
+        self.flask_app = flask_app
+        self.wsgi = WSGIMiddleware(flask_app, workers=threads)
+        self.executor = ThreadPoolExecutor(DB_THREADS)
+        self.notifier = ChangeNotifier(self)
+
+    async def run_in_app(self, func, *args, owner=None):
+        """在线程池中以 Flask 应用上下文执行 func"""
+        def call():
+            with self.flask_app.app_context():
+                g.owner_id = owner
+                return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == '/api/changes' and scope['method'] == 'GET':
+            await self.changes(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def changes(self, scope, receive, send):
+        # 与 app.get_changes 相同的参数处理；参数或令牌无效以及无需等待的请求直接交给 Flask
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        try:
+            since = int(headers.get('last-event-id') or args.get('since', '0'))
+            wait = min(float(args.get('wait', 0)), MAX_CHANGE_WAIT)
+        except ValueError:
+            return await self.wsgi(scope, receive, send)
+        stream = parse_accept_header(headers.get('accept'), MIMEAccept).best == 'text/event-stream'
+        if not stream and not wait > 0:
+            return await self.wsgi(scope, receive, send)
+        owner = await self.authenticate(args, headers)
+        if owner is None:
+            return await self.wsgi(scope, receive, send)
+
+        if not stream:
+            # 等到有变更或超时后，以 wait=0 交给 Flask 生成响应；响应头告知页面可以改用 Server-Sent Events
+            await self.notifier.wait(owner, since, wait)
+            args['wait'] = '0'
+            scope = dict(scope, query_string=urlencode(args).encode('latin-1'))
+            return await self.wsgi(scope, receive, partial(self.advertise_stream, send))
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        stream_task = asyncio.ensure_future(self.stream_changes(owner, since, send))
+        disconnect_task = asyncio.ensure_future(self.wait_disconnect(receive))
+        done, pending = await asyncio.wait((stream_task, disconnect_task), return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if stream_task in done:
+            stream_task.result()
+            await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def advertise_stream(send, message):
+        if message['type'] == 'http.response.start':
+            message = dict(message, headers=[*message.get('headers', []), (b'x-change-stream', b'sse')])
+        await send(message)
+
+    async def authenticate(self, args, headers):
+        # 与 app.authenticate 相同的规则；返回 None 表示应由 Flask 返回 401
+        header = headers.get('authorization', '')
+        token = header[len('Bearer '):] if header.startswith('Bearer ') else args.get('token')
+        if token:
+            return await self.run_in_app(token_owner, token)
+        return None if self.flask_app.config['REQUIRE_AUTH'] else ANONYMOUS_OWNER
+
+    async def stream_changes(self, owner, since, send):
+        async def emit(text):
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+        await emit('retry: 3000\n\n')
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        while time.monotonic() < deadline:
+            seq = await self.notifier.wait(owner, since, SSE_KEEPALIVE)
+            if seq <= since:
+                await emit(': keepalive\n\n')
+                continue
+            for change in await self.run_in_app(changes_since, since, owner=owner):
+                await emit(f"id: {change['seq']}\ndata: {json.dumps(change, ensure_ascii=False)}\n\n")
+                seq = max(seq, change['seq'])
+            since = seq
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+def create_app(config=None):
+    """创建 Flask 应用并包装为 ASGI 应用，供 gunicorn 以 'asgi:create_app()' 调用"""
+    flask_app = create_flask_app(config)
+    return ScheduleApp(flask_app, threads=int(os.environ.get('GUNICORN_THREADS', 4)))
@@ -0,0 +1,46 @@
+"""按变更序号失效的响应缓存
+
+缓存序列化后的响应体，按总字节数做 LRU 淘汰。每个条目记录生成时的变更序号，
+序号变化后条目自动失效，不需要逐条清理。
+"""
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, seq):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != seq:
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, seq, body, headers):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (seq, body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
@@ -1,12 +1,106 @@
+import os
 import sys
-import requests
+import bisect
+import hashlib
 from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                            QHBoxLayout, QPushButton, QLabel, QLineEdit,
                            QCalendarWidget, QTimeEdit, QTableWidget,
                            QTableWidgetItem, QMessageBox)
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, QTimer, QObject, QRunnable, QThreadPool, pyqtSignal
 from win10toast import ToastNotifier
+from local_cache import LocalCache, default_path
+
+# Upper bound between reminder checks, so reminders added elsewhere are picked up
+REMINDER_POLL_MAX = 300
+# Interval for pulling incremental changes from the server (ms)
+CHANGE_SYNC_INTERVAL = 30000
+# Network settings: (connect, read) timeouts in seconds, retries with exponential backoff
+REQUEST_TIMEOUT = (3.05, 10)
+REQUEST_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_NETWORK_THREADS = 4
+# Queued offline writes replayed per batch request
+PENDING_BATCH_SIZE = 500
+
+class RequestSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+
+class RequestTask(QRunnable):
+    def __init__(self, session, method, url, kwargs):
+        super().__init__()
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.signals = RequestSignals()
+    
+    def run(self):
+        try:
+            response = self.session.request(self.method, self.url, timeout=REQUEST_TIMEOUT, **self.kwargs)
+        except Exception as e:
+            self.signals.failed.emit(e)
+        else:
+            self.signals.finished.emit(response)
+
+class ApiClient(QObject):
+    """Runs API requests on a thread pool and delivers results on the GUI thread.
+    
+    A single pooled keep-alive session is shared by all requests. Idempotent
+    requests are retried with backoff, and an identical GET that is already in
+    flight is reused instead of being sent again.
+    """
+    def __init__(self, base_url, token=None, parent=None):
+        super().__init__(parent)
+        self.base_url = base_url
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+        retry = Retry(total=REQUEST_RETRIES, backoff_factor=RETRY_BACKOFF,
+                      status_forcelist=(502, 503, 504), allowed_methods=('GET', 'PUT', 'DELETE'))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_NETWORK_THREADS, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(MAX_NETWORK_THREADS)
+        self.in_flight = {}
+        # Tasks must stay referenced until their signals have been delivered
+        self.tasks = set()
+    
+    def get(self, path, on_success, on_error=None, **kwargs):
+        self.request('GET', path, on_success, on_error, **kwargs)
+    
+    def post(self, path, on_success, on_error=None, **kwargs):
+        self.request('POST', path, on_success, on_error, **kwargs)
+    
+    def request(self, method, path, on_success, on_error=None, **kwargs):
+        key = None
+        if method == 'GET':
+            key = (path, repr(sorted(kwargs.get('params', {}).items())), repr(sorted(kwargs.get('headers', {}).items())))
+            if key in self.in_flight:
+                self.in_flight[key].append((on_success, on_error))
+                return
+            self.in_flight[key] = [(on_success, on_error)]
+        callbacks = [(on_success, on_error)]
+        task = RequestTask(self.session, method, f"{self.base_url}{path}", kwargs)
+        task.setAutoDelete(False)
+        task.signals.finished.connect(lambda response: self._deliver(task, key, callbacks, response, 0))
+        task.signals.failed.connect(lambda error: self._deliver(task, key, callbacks, error, 1))
+        self.tasks.add(task)
+        self.pool.start(task)
+    
+    def _deliver(self, task, key, callbacks, result, which):
+        self.tasks.discard(task)
+        if key is not None:
+            callbacks = self.in_flight.pop(key, callbacks)
+        for callback_pair in callbacks:
+            callback = callback_pair[which]
+            if callback is not None:
+                callback(result)
 
 class SchedulePlanner(QMainWindow):
     def __init__(self):
@@ -16,6 +110,9 @@ class SchedulePlanner(QMainWindow):
         
         # API configuration
         self.api_url = "http://localhost:5000/api"  # Change this to your deployed API URL
+        # Access token printed by `flask create-user`; without one the server's anonymous data is used
+        self.api_token = os.environ.get("SCHEDULE_API_TOKEN")
+        self.api = ApiClient(self.api_url, self.api_token, self)
         
         # Initialize Windows notifier
         self.toaster = ToastNotifier()
@@ -74,64 +171,204 @@ class SchedulePlanner(QMainWindow):
         refresh_button.clicked.connect(self.load_schedules)
         layout.addWidget(refresh_button)
         
-        # Set up timer for checking reminders
+        # Rows are kept sorted by (date, start_time, id) so changes can be patched in place
+        # The cache belongs to one server and one user; a different token starts a fresh cache
+        cache_owner = hashlib.sha256(self.api_token.encode()).hexdigest()[:16] if self.api_token else "anonymous"
+        self.cache = LocalCache(default_path(), f"{self.api_url}#{cache_owner}")
+        self.change_seq = self.cache.change_seq
+        self.list_etag = self.cache.list_etag
+        self.row_keys = []
+        self.row_key_by_id = {}
+        self.flushing = False
+        self.sync_timer = QTimer()
+        self.sync_timer.timeout.connect(self.sync_changes)
+        self.sync_timer.start(CHANGE_SYNC_INTERVAL)
+        
+        # Set up timer for checking reminders; it is re-armed for the next due reminder
+        self.reminder_since = None
         self.timer = QTimer()
+        self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.check_reminders)
-        self.timer.start(60000)  # Check every minute
         
-        # Load initial schedules
-        self.load_schedules()
+        # Paint from the local cache, then catch up with the server in the background
+        self.show_schedules(self.cache.schedules())
+        if self.change_seq:
+            self.sync_changes()
+        else:
+            self.load_schedules()
+        self.check_reminders()
+    
+    def show_network_error(self, action, error):
+        # Background failures go to the status bar instead of a modal dialog
+        self.statusBar().showMessage(f"{action} failed: {error}", 10000)
     
     def load_schedules(self):
+        # The server answers 304 when nothing changed since the last full load
+        headers = {'If-None-Match': self.list_etag} if self.list_etag else {}
+        self.api.get("/schedules", self.on_schedules_loaded,
+                     lambda e: self.show_network_error("Loading schedules", e), headers=headers)
+    
+    def on_schedules_loaded(self, response):
+        if response.status_code == 200:
+            self.list_etag = response.headers.get('ETag')
+            self.change_seq = int(response.headers.get('X-Change-Seq', 0))
+            self.cache.replace_all(response.json(), self.change_seq, self.list_etag)
+            self.show_schedules(self.cache.schedules())
+        self.flush_pending()
+    
+    def show_schedules(self, schedules):
+        self.row_keys = [self.row_key(schedule) for schedule in schedules]
+        self.row_key_by_id = {key[2]: key for key in self.row_keys}
+        self.table.setRowCount(len(schedules))
+        for i, schedule in enumerate(schedules):
+            self.set_row(i, schedule)
+    
+    def sync_changes(self):
+        self.api.get("/changes", self.on_changes, lambda e: self.show_network_error("Syncing changes", e),
+                     params={'since': self.change_seq})
+    
+    def on_changes(self, response):
+        if response.status_code != 200:
+            return
+        data = response.json()
+        if data['seq'] < self.change_seq:
+            # The server's sequence went backwards (e.g. a restored database); the cache can't be patched
+            self.list_etag = None
+            self.load_schedules()
+            return
+        if data['seq'] > self.change_seq:
+            for change in data['changes']:
+                self.apply_change(change)
+            self.change_seq = data['seq']
+            self.cache.apply_changes(data['changes'], self.change_seq)
+            self.list_etag = None
+        # The server is reachable again, so replay anything written while offline
+        self.flush_pending()
+    
+    def flush_pending(self):
+        if self.flushing:
+            return
+        pending = self.cache.pending()[:PENDING_BATCH_SIZE]
+        if not pending:
+            return
+        operations = []
+        for item in pending:
+            operation = {'op': item['op']}
+            if item['op'] != 'create':
+                operation['id'] = item['schedule_id']
+                operation['base_seq'] = item['base_seq']
+            if item['data'] is not None:
+                operation['data'] = item['data']
+            operations.append(operation)
+        self.flushing = True
+        self.api.post("/schedules/batch", lambda response: self.on_pending_replayed(pending, response),
+                      self.on_pending_failed, json=operations)
+    
+    def on_pending_failed(self, error):
+        self.flushing = False
+        self.statusBar().showMessage(f"Offline: {len(self.cache.pending())} change(s) waiting to sync ({error})", 10000)
+    
+    def on_pending_replayed(self, pending, response):
+        self.flushing = False
         try:
-            response = requests.get(f"{self.api_url}/schedules")
-            if response.status_code == 200:
-                schedules = response.json()
-                self.table.setRowCount(len(schedules))
-                for i, schedule in enumerate(schedules):
-                    self.table.setItem(i, 0, QTableWidgetItem(str(schedule['id'])))
-                    self.table.setItem(i, 1, QTableWidgetItem(schedule['title']))
-                    self.table.setItem(i, 2, QTableWidgetItem(schedule['date']))
-                    self.table.setItem(i, 3, QTableWidgetItem(schedule['start_time']))
-                    self.table.setItem(i, 4, QTableWidgetItem(schedule['end_time']))
-                    self.table.setItem(i, 5, QTableWidgetItem(schedule['reminder_time'] or ""))
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to load schedules: {str(e)}")
+            data = response.json()
+        except ValueError:
+            data = {}
+        if 'results' not in data:
+            self.on_pending_failed(f"HTTP {response.status_code}")
+            return
+        # The batch is all-or-nothing: on failure, writes the server rejected are dropped (its copy wins)
+        # and the ones marked 424 stay queued for the next attempt
+        rejected, resolved = [], 0
+        for item, result in zip(pending, data['results']):
+            if result['status'] == 424:
+                continue
+            resolved += 1
+            schedule = result.get('schedule')
+            self.cache.resolve(item['id'], item['schedule_id'], schedule, data.get('seq', 0))
+            if item['schedule_id'] is not None and item['schedule_id'] < 0:
+                self.apply_change({'id': item['schedule_id'], 'deleted': True})
+            if schedule is not None:
+                self.apply_change(schedule)
+            if result['status'] >= 400:
+                title = (item['data'] or {}).get('title', item['schedule_id'])
+                rejected.append(f"{item['op']} {title}: {result.get('error', 'Unknown error')}")
+        if rejected:
+            QMessageBox.warning(self, "Sync", "Some offline changes were rejected:\n" + "\n".join(rejected))
+            # Local edits that lost to the server were never in the change feed, so reload everything
+            self.list_etag = None
+            self.load_schedules()
+        else:
+            self.statusBar().clearMessage()
+            self.check_reminders()
+        if resolved:
+            self.flush_pending()
+    
+    def apply_change(self, change):
+        old_key = self.row_key_by_id.pop(change['id'], None)
+        if old_key is not None:
+            row = bisect.bisect_left(self.row_keys, old_key)
+            del self.row_keys[row]
+            self.table.removeRow(row)
+        if change.get('deleted'):
+            return
+        key = self.row_key(change)
+        row = bisect.bisect_left(self.row_keys, key)
+        self.row_keys.insert(row, key)
+        self.row_key_by_id[change['id']] = key
+        self.table.insertRow(row)
+        self.set_row(row, change)
+    
+    @staticmethod
+    def row_key(schedule):
+        return (schedule['date'], schedule['start_time'], schedule['id'])
+    
+    def set_row(self, row, schedule):
+        # Rows created offline have a negative placeholder id until they are synced
+        self.table.setItem(row, 0, QTableWidgetItem(str(schedule['id']) if schedule['id'] > 0 else "pending"))
+        self.table.setItem(row, 1, QTableWidgetItem(schedule['title']))
+        self.table.setItem(row, 2, QTableWidgetItem(schedule['date']))
+        self.table.setItem(row, 3, QTableWidgetItem(schedule['start_time']))
+        self.table.setItem(row, 4, QTableWidgetItem(schedule['end_time']))
+        self.table.setItem(row, 5, QTableWidgetItem(schedule['reminder_time'] or ""))
     
     def add_schedule(self):
-        try:
-            data = {
-                'title': self.title_input.text(),
-                'date': self.calendar.selectedDate().toString("yyyy-MM-dd"),
-                'start_time': self.start_time.time().toString("HH:mm"),
-                'end_time': self.end_time.time().toString("HH:mm"),
-                'reminder_time': self.reminder_time.time().toString("HH:mm")
-            }
-            
-            response = requests.post(f"{self.api_url}/schedules", json=data)
-            if response.status_code == 201:
-                self.load_schedules()
-                self.title_input.clear()
-            else:
-                QMessageBox.critical(self, "Error", f"Failed to add schedule: {response.json().get('error', 'Unknown error')}")
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to add schedule: {str(e)}")
+        data = {
+            'title': self.title_input.text(),
+            'date': self.calendar.selectedDate().toString("yyyy-MM-dd"),
+            'start_time': self.start_time.time().toString("HH:mm"),
+            'end_time': self.end_time.time().toString("HH:mm"),
+            'reminder_time': self.reminder_time.time().toString("HH:mm")
+        }
+        # Every write goes through the local queue, so adding works the same with or without a connection
+        placeholder_id = self.cache.queue('create', data=data)
+        self.apply_change(dict(data, id=placeholder_id))
+        self.title_input.clear()
+        self.flush_pending()
     
     def check_reminders(self):
-        try:
-            now = datetime.now()
-            current_date = now.strftime("%Y-%m-%d")
-            current_time = now.strftime("%H:%M")
-            
-            response = requests.get(f"{self.api_url}/schedules")
-            if response.status_code == 200:
-                schedules = response.json()
-                for schedule in schedules:
-                    if (schedule['date'] == current_date and 
-                        schedule['reminder_time'] == current_time):
-                        self.show_reminder(schedule)
-        except Exception as e:
-            print(f"Error checking reminders: {str(e)}")
+        # Reminder times are local wall-clock times, so the server judges "due" by our clock
+        params = {'now': datetime.now().strftime('%Y-%m-%dT%H:%M')}
+        if self.reminder_since:
+            params['since'] = self.reminder_since
+        self.api.get("/reminders/due", self.on_reminders, self.on_reminders_failed, params=params)
+    
+    def on_reminders(self, response):
+        delay = REMINDER_POLL_MAX
+        if response.status_code == 200:
+            data = response.json()
+            for schedule in data['reminders']:
+                self.show_reminder(schedule)
+            self.reminder_since = data['until']
+            if data['next_due'] is not None:
+                # next_due_in is measured from the minute we sent; count from the actual local time
+                next_due = datetime.strptime(data['next_due'], '%Y-%m-%d %H:%M')
+                delay = min(delay, max(int((next_due - datetime.now()).total_seconds()), 1))
+        self.timer.start(delay * 1000)
+    
+    def on_reminders_failed(self, error):
+        print(f"Error checking reminders: {str(error)}")
+        self.timer.start(REMINDER_POLL_MAX * 1000)
     
     def show_reminder(self, schedule):
         message = f"即将开始: {schedule['title']}\n时间: {schedule['start_time']} - {schedule['end_time']}"
@@ -0,0 +1,2 @@
+# test_reminder.py 是针对运行中服务器的手动脚本，不是 pytest 测试
+collect_ignore = ['test_reminder.py']
@@ -0,0 +1,211 @@
+"""iCalendar (RFC 5545) 的生成与增量解析
+
+只覆盖本应用用到的部分：VEVENT 的标题、起止时间、重复规则、排除日期和一个
+提醒（VALARM）。时间均为不带时区的本地时间。生成和解析都按行进行，不需要
+把整个日历读入内存。
+"""
+from datetime import datetime, timedelta
+
+from validation import ValidationError
+
+PRODID = '-//SchedulePlanner//Schedule Planner//ZH'
+UID_DOMAIN = 'schedule-planner'
+FREQ_NAMES = {'daily': 'DAILY', 'weekly': 'WEEKLY', 'monthly': 'MONTHLY'}
+
+
+def escape_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def unescape_text(value):
+    result, i = [], 0
+    while i < len(value):
+        if value[i] == '\\' and i + 1 < len(value):
+            result.append('\n' if value[i + 1] in 'nN' else value[i + 1])
+            i += 2
+        else:
+            result.append(value[i])
+            i += 1
+    return ''.join(result)
+
+
+def fold(line):
+    # 每行不超过 75 个字节，续行以空格开头
+    parts, current, size = [], [], 0
+    for char in line:
+        width = len(char.encode('utf-8'))
+        if size + width > 75:
+            parts.append(''.join(current))
+            current, size = [' '], 1
+        current.append(char)
+        size += width
+    parts.append(''.join(current))
+    return '\r\n'.join(parts) + '\r\n'
+
+
+def format_datetime(day, clock):
+    # day 为 YYYY-MM-DD，clock 为 HH:MM
+    return f"{day.replace('-', '')}T{clock.replace(':', '')}00"
+
+
+def calendar_header(name=None):
+    yield 'BEGIN:VCALENDAR\r\n'
+    yield 'VERSION:2.0\r\n'
+    yield f'PRODID:{PRODID}\r\n'
+    yield 'CALSCALE:GREGORIAN\r\n'
+    if name:
+        yield fold(f'X-WR-CALNAME:{escape_text(name)}')
+
+
+def calendar_footer():
+    yield 'END:VCALENDAR\r\n'
+
+
+def format_event(schedule, stamp):
+    """把 Schedule.to_dict() 的结果转换为一个 VEVENT 文本块；stamp 为 DTSTAMP 使用的 UTC 时间。"""
+    start = format_datetime(schedule['date'], schedule['start_time'])
+    lines = [
+        'BEGIN:VEVENT',
+        f"UID:{schedule['id']}@{UID_DOMAIN}",
+        f"DTSTAMP:{stamp.strftime('%Y%m%dT%H%M%SZ')}",
+        f'DTSTART:{start}',
+        f"DTEND:{format_datetime(schedule['date'], schedule['end_time'])}",
+        f"SUMMARY:{escape_text(schedule['title'])}",
+    ]
+    recurrence = schedule.get('recurrence')
+    if recurrence:
+        rule = f"FREQ={FREQ_NAMES[recurrence['freq']]};INTERVAL={recurrence['interval'] or 1}"
+        if recurrence['count']:
+            rule += f";COUNT={recurrence['count']}"
+        if recurrence['until']:
+            rule += f";UNTIL={recurrence['until'].replace('-', '')}T235959"
+        lines.append(f'RRULE:{rule}')
+        if recurrence['exdates']:
+            lines.append('EXDATE:' + ','.join(format_datetime(day, schedule['start_time'])
+                                              for day in recurrence['exdates']))
+    if schedule['reminder_time']:
+        # 提醒时刻相对开始时间的偏移，早于开始时间为负
+        offset = (datetime.strptime(schedule['reminder_time'], '%H:%M')
+                  - datetime.strptime(schedule['start_time'], '%H:%M'))
+        minutes = int(offset.total_seconds() // 60)
+        lines += [
+            'BEGIN:VALARM',
+            'ACTION:DISPLAY',
+            f"DESCRIPTION:{escape_text(schedule['title'])}",
+            f"TRIGGER:{'-' if minutes < 0 else ''}PT{abs(minutes)}M",
+            'END:VALARM',
+        ]
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) for line in lines)
+
+
+def unfolded_lines(lines):
+    """把按物理行迭代的输入还原为逻辑行。"""
+    current = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def parse_line(line):
+    # NAME;PARAM=VALUE:value，返回 (名称, 参数字典, 值)
+    head, sep, value = line.partition(':')
+    if not sep:
+        raise ValidationError(f'Invalid iCalendar line: {line[:40]}')
+    name, *params = head.split(';')
+    return name.upper(), dict(param.partition('=')[::2] for param in params), value
+
+
+def iter_events(lines):
+    """逐个产生 VEVENT 的属性字典 {名称: (参数, 值)}；VALARM 的属性放在 'VALARM' 键下。"""
+    event = alarm = None
+    for line in unfolded_lines(lines):
+        name, params, value = parse_line(line)
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {}
+        elif name == 'BEGIN' and value.upper() == 'VALARM' and event is not None:
+            alarm = {}
+        elif name == 'END' and value.upper() == 'VALARM' and alarm is not None:
+            event.setdefault('VALARM', alarm)
+            alarm = None
+        elif name == 'END' and value.upper() == 'VEVENT' and event is not None:
+            yield event
+            event = None
+        elif alarm is not None:
+            alarm[name] = (params, value)
+        elif event is not None:
+            event[name] = (params, value)
+
+
+def parse_ics_datetime(value):
+    # 接受 YYYYMMDD 和 YYYYMMDDTHHMM[SS][Z]，忽略时区
+    try:
+        if 'T' not in value:
+            return datetime.strptime(value[:8], '%Y%m%d')
+        return datetime.strptime(value[:13], '%Y%m%dT%H%M')
+    except ValueError:
+        raise ValidationError('Invalid date or time format')
+
+
+def parse_trigger(value):
+    # 只支持相对开始时间的 [-]PT#H#M / [-]P#D 形式
+    sign = -1 if value.startswith('-') else 1
+    value = value.lstrip('+-')
+    if not value.startswith('P'):
+        raise ValidationError('Unsupported alarm trigger')
+    total, number = timedelta(), ''
+    units = {'W': timedelta(weeks=1), 'D': timedelta(days=1), 'H': timedelta(hours=1),
+             'M': timedelta(minutes=1), 'S': timedelta(seconds=1)}
+    for char in value[1:]:
+        if char.isdigit():
+            number += char
+        elif char in units and number:
+            total += int(number) * units[char]
+            number = ''
+        elif char != 'T':
+            raise ValidationError('Unsupported alarm trigger')
+    return sign * total
+
+
+def event_to_schedule(event):
+    """把 iter_events 产生的 VEVENT 转换为创建日程的请求数据。"""
+    if 'DTSTART' not in event:
+        raise ValidationError("Missing or invalid field: 'date'")
+    start = parse_ics_datetime(event['DTSTART'][1])
+    end = parse_ics_datetime(event['DTEND'][1]) if 'DTEND' in event else start + timedelta(hours=1)
+    data = {
+        'title': unescape_text(event['SUMMARY'][1]) if 'SUMMARY' in event else '',
+        'date': start.strftime('%Y-%m-%d'),
+        'start_time': start.strftime('%H:%M'),
+        'end_time': end.strftime('%H:%M') if end.date() == start.date() else '23:59',
+    }
+    if 'VALARM' in event and 'TRIGGER' in event['VALARM']:
+        remind_at = start + parse_trigger(event['VALARM']['TRIGGER'][1])
+        data['reminder_time'] = remind_at.strftime('%H:%M')
+    if 'RRULE' in event:
+        parts = dict(part.partition('=')[::2] for part in event['RRULE'][1].upper().split(';'))
+        freqs = {name: freq for freq, name in FREQ_NAMES.items()}
+        if parts.get('FREQ') not in freqs:
+            raise ValidationError('Unsupported recurrence rule')
+        try:
+            recurrence = {'freq': freqs[parts['FREQ']], 'interval': int(parts.get('INTERVAL', 1))}
+            if 'COUNT' in parts:
+                recurrence['count'] = int(parts['COUNT'])
+        except ValueError:
+            raise ValidationError('Unsupported recurrence rule')
+        if 'UNTIL' in parts:
+            recurrence['until'] = parse_ics_datetime(parts['UNTIL']).strftime('%Y-%m-%d')
+        if 'EXDATE' in event:
+            recurrence['exdates'] = [parse_ics_datetime(day).strftime('%Y-%m-%d')
+                                     for day in event['EXDATE'][1].split(',')]
+        data['recurrence'] = recurrence
+    return data
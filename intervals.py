@@ -0,0 +1,85 @@
+"""按天划分的区间索引，用于日程冲突检测和空闲时段查询
+
+每天的区间按开始时间排序保存。日程不跨天，区间长度不超过当天出现过的最长
+区间，因此查询时从 start - 最长区间 处二分定位，只需检查可能重叠的区间，
+复杂度为 O(log n + k)。区间均为左闭右开，首尾相接不算重叠。
+
+查询方法的 extra 参数用于传入当天额外的 (start, end, id) 区间（如重复日程的
+发生），它们不进入索引，只参与本次查询。
+"""
+import bisect
+import heapq
+
+
+class DayIntervalIndex:
+    def __init__(self):
+        self._days = {}
+        self._longest = {}
+        self._by_id = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def add(self, id, day, start, end):
+        self.remove(id)
+        entries = self._days.setdefault(day, [])
+        bisect.insort(entries, (start, end, id))
+        self._longest[day] = max(self._longest.get(day, 0), end - start)
+        self._by_id[id] = (day, start, end)
+
+    def remove(self, id):
+        entry = self._by_id.pop(id, None)
+        if entry is None:
+            return
+        day, start, end = entry
+        entries = self._days[day]
+        del entries[bisect.bisect_left(entries, (start, end, id))]
+        if not entries:
+            del self._days[day]
+            del self._longest[day]
+
+    def overlapping(self, day, start, end, exclude=None, extra=()):
+        """返回与 [start, end) 重叠的区间 id，按开始时间排序。"""
+        found = [entry for entry in extra if entry[0] < end and entry[1] > start and entry[2] != exclude]
+        entries = self._days.get(day)
+        if entries:
+            i = bisect.bisect_left(entries, (start - self._longest[day],))
+            while i < len(entries) and entries[i][0] < end:
+                if entries[i][1] > start and entries[i][2] != exclude:
+                    found.append(entries[i])
+                i += 1
+        return [id for _, _, id in sorted(found)]
+
+    def _entries(self, day, extra):
+        entries = self._days.get(day, [])
+        return heapq.merge(entries, sorted(extra)) if extra else entries
+
+    def free_slots(self, day, day_start, day_end, duration, extra=()):
+        """在 [day_start, day_end) 内合并重叠区间后扫描一遍，返回长度不小于 duration 的空闲区间。"""
+        slots = []
+        cursor = day_start
+        for start, end, _ in self._entries(day, extra):
+            if start >= day_end:
+                break
+            if start - cursor >= duration:
+                slots.append((cursor, start))
+            cursor = max(cursor, end)
+        if day_end - cursor >= duration:
+            slots.append((cursor, day_end))
+        return slots
+
+    def clusters(self, day, extra=()):
+        """按开始时间扫描一遍，返回当天互相重叠（可传递）的区间组，每组至少两个 id。"""
+        groups = []
+        group, group_end = [], None
+        for start, end, id in self._entries(day, extra):
+            if group and start < group_end:
+                group.append(id)
+                group_end = max(group_end, end)
+                continue
+            if len(group) > 1:
+                groups.append(group)
+            group, group_end = [id], end
+        if len(group) > 1:
+            groups.append(group)
+        return groups
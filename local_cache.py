@@ -0,0 +1,134 @@
+"""On-disk cache for the desktop client.
+
+Schedules are stored by id together with the server change sequence they were
+last synced at, so the window can be painted from disk at startup and then
+caught up through /api/changes. Writes made while the server is unreachable
+are kept in a queue and replayed through /api/schedules/batch later.
+"""
+import json
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schedule (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    date TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    reminder_time TEXT,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_schedule_date_start_time_id ON schedule (date, start_time, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS pending (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    schedule_id INTEGER,
+    data TEXT,
+    base_seq INTEGER
+);
+"""
+
+FIELDS = ('id', 'title', 'date', 'start_time', 'end_time', 'reminder_time', 'seq')
+
+
+def default_path():
+    return os.path.join(os.path.expanduser('~'), '.schedule_planner', 'cache.db')
+
+
+class LocalCache:
+    def __init__(self, path, source):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        # A cache filled from a different server or account must not be mixed with this one
+        if self.get_meta('api_url') != source:
+            with self.conn:
+                self.conn.execute('DELETE FROM schedule')
+                self.conn.execute('DELETE FROM pending')
+                self.conn.execute('DELETE FROM meta')
+                self.set_meta('api_url', source)
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def change_seq(self):
+        return int(self.get_meta('change_seq', 0))
+
+    @property
+    def list_etag(self):
+        return self.get_meta('list_etag')
+
+    def schedules(self):
+        rows = self.conn.execute('SELECT * FROM schedule ORDER BY date, start_time, id')
+        return [dict(row) for row in rows]
+
+    def replace_all(self, schedules, change_seq, list_etag):
+        with self.conn:
+            # Rows for queued creates have negative ids and survive a full reload
+            self.conn.execute('DELETE FROM schedule WHERE id > 0')
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO schedule ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})",
+                [self._values(schedule) for schedule in schedules])
+            self.set_meta('change_seq', str(change_seq))
+            self.set_meta('list_etag', list_etag)
+
+    def apply_changes(self, changes, change_seq):
+        with self.conn:
+            for change in changes:
+                self._apply(change)
+            self.set_meta('change_seq', str(change_seq))
+            # Any change makes the stored list ETag stale
+            self.set_meta('list_etag', None)
+
+    def put(self, schedule):
+        with self.conn:
+            self._apply(schedule)
+
+    def _apply(self, change):
+        if change.get('deleted'):
+            self.conn.execute('DELETE FROM schedule WHERE id = ?', (change['id'],))
+        else:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO schedule ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})",
+                self._values(change))
+
+    @staticmethod
+    def _values(schedule):
+        return tuple(schedule.get(field, 0) if field == 'seq' else schedule.get(field) for field in FIELDS)
+
+    def queue(self, op, schedule_id=None, data=None, base_seq=None):
+        """Queue a write for replay. Creates get a negative placeholder id that is shown until the server assigns one."""
+        with self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO pending (op, schedule_id, data, base_seq) VALUES (?, ?, ?, ?)',
+                (op, schedule_id, json.dumps(data) if data is not None else None, base_seq))
+            if op == 'create':
+                schedule_id = -cursor.lastrowid
+                self.conn.execute('UPDATE pending SET schedule_id = ? WHERE id = ?', (schedule_id, cursor.lastrowid))
+                self._apply(dict(data, id=schedule_id, seq=0))
+        return schedule_id
+
+    def pending(self):
+        rows = self.conn.execute('SELECT * FROM pending ORDER BY id')
+        return [dict(row, data=json.loads(row['data']) if row['data'] else None) for row in rows]
+
+    def resolve(self, pending_id, schedule_id, result=None, seq=0):
+        """Drop a replayed or rejected write and its placeholder row; store the server's copy if there is one."""
+        with self.conn:
+            self.conn.execute('DELETE FROM pending WHERE id = ?', (pending_id,))
+            if schedule_id is not None and schedule_id < 0:
+                self.conn.execute('DELETE FROM schedule WHERE id = ?', (schedule_id,))
+            if result is not None:
+                self._apply(dict(result, seq=seq))
@@ -0,0 +1,107 @@
+"""进程内的请求指标，以 Prometheus 文本格式输出
+
+计数器和直方图按标签组合分别累计，读写由各自的锁保护，可在多线程 worker 中
+使用。每个 gunicorn worker 进程有各自的一份数据，抓取时会得到处理该请求的
+worker 的数值，标签 pid 用于区分。
+"""
+import bisect
+import os
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = ('pid',) + tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        key = (os.getpid(),) + tuple(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{format_labels(self.labels, key)} {format_number(value)}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = ('pid',) + tuple(labels)
+        self.buckets = tuple(buckets)
+        # 标签组合 -> [各区间计数..., 总和]，区间计数不累加，输出时再求累积值
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = (os.getpid(),) + tuple(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            entry[position] += 1
+            entry[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(entry)) for key, entry in self._values.items())
+        for key, entry in items:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry):
+                total += count
+                labels = format_labels(self.labels + ('le',), key + (bound,))
+                yield f'{self.name}_bucket{labels} {total}'
+            labels = format_labels(self.labels, key)
+            yield f'{self.name}_count{labels} {total}'
+            yield f'{self.name}_sum{labels} {format_number(entry[-1])}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
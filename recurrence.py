@@ -0,0 +1,81 @@
+"""重复日程的规则与按需展开
+
+规则只存一份，查询时只展开落在查询窗口内的日期。展开结果按 (规则, 窗口)
+缓存在有界的 LRU 中；规则内容本身是缓存键，修改规则后旧的展开结果不会再命中。
+"""
+import calendar
+from collections import namedtuple
+from datetime import date, timedelta
+from functools import lru_cache
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+EXPANSION_CACHE_SIZE = 1024
+
+# start: 首次日期；count/until 可为 None；exdates 为排除日期的元组
+Rule = namedtuple('Rule', 'start freq interval count until exdates')
+
+
+def _nth(rule, k):
+    # 第 k 个候选日期；按月重复时当月没有该日（如 31 日）则返回 None，且不计入次数
+    if rule.freq == 'daily':
+        return rule.start + timedelta(days=k * rule.interval)
+    if rule.freq == 'weekly':
+        return rule.start + timedelta(weeks=k * rule.interval)
+    month = rule.start.month - 1 + k * rule.interval
+    year = rule.start.year + month // 12
+    month = month % 12 + 1
+    if rule.start.day > calendar.monthrange(year, month)[1]:
+        return None
+    return date(year, month, rule.start.day)
+
+
+def _first_index(rule, window_from):
+    # 直接跳到窗口附近的候选序号，不从首次日期逐个生成
+    if window_from <= rule.start:
+        return 0
+    if rule.freq == 'monthly':
+        if rule.count is not None:
+            # 有次数限制时需要从头数有效日期
+            return 0
+        months = (window_from.year - rule.start.year) * 12 + window_from.month - rule.start.month
+        return months // rule.interval
+    step = rule.interval * (7 if rule.freq == 'weekly' else 1)
+    return -(-(window_from - rule.start).days // step)
+
+
+@lru_cache(maxsize=EXPANSION_CACHE_SIZE)
+def occurrences(rule, window_from, window_to):
+    """返回规则在 [window_from, window_to] 内的发生日期元组。"""
+    dates = []
+    k = _first_index(rule, window_from)
+    # 按天、按周重复时每个候选都有效，序号即已发生次数
+    seen = k
+    while rule.count is None or seen < rule.count:
+        try:
+            day = _nth(rule, k)
+        except (ValueError, OverflowError):
+            break
+        k += 1
+        if day is None:
+            continue
+        seen += 1
+        if day > window_to or (rule.until is not None and day > rule.until):
+            break
+        if day >= window_from and day not in rule.exdates:
+            dates.append(day)
+    return tuple(dates)
+
+
+def last_occurrence(rule):
+    """最后一次可能发生的日期，规则无限重复时返回 None。"""
+    if rule.count is None:
+        return rule.until
+    end = rule.until or date.max
+    found = occurrences(rule._replace(exdates=()), rule.start, end)
+    return found[-1] if found else rule.start
+
+
+def next_occurrence(rule, after, horizon):
+    """after 之后（不含）horizon 天内的下一次发生日期。"""
+    found = occurrences(rule, after + timedelta(days=1), after + timedelta(days=horizon))
+    return found[0] if found else None
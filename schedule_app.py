@@ -1,8 +1,14 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 from datetime import datetime, timedelta
-import json
+import bisect
 import os
+from schedule_store import StoreError, open_store
+
+# 日程数达到该值时列表只创建视口内的行
+VIRTUAL_ROWS_THRESHOLD = 2000
+# 鼠标滚轮每格滚动的行数
+WHEEL_ROWS = 3
 
 class EditDialog:
     def __init__(self, parent, schedule):
@@ -84,15 +90,152 @@ class EditDialog:
         }
         self.dialog.destroy()
 
+class ScheduleList:
+    """日程列表
+
+    按 (日期, 开始时间, id) 用 bisect 维护有序索引，增删改只修改受影响的行，
+    不再整表重建。windowed 为 True 时只创建一屏的行，滚动时把有序索引中对应
+    位置的日程填入这些行，创建的行数与日程总数无关。
+
+    schedules 是与应用共用的 id -> 日程字典，调用 add/update/remove 之前应先
+    更新字典；列表自己只保存各 id 在有序索引中的键。
+    """
+    def __init__(self, parent, columns, schedules, windowed=False):
+        self.tree = ttk.Treeview(parent, columns=columns, show="headings")
+        self.windowed = windowed
+        self.schedules = schedules
+        self.keys = []
+        self.key_by_id = {}
+        # 窗口模式：第一个可见行在有序索引中的位置、可见行数和各行对应的日程 id
+        self.offset = 0
+        self.rows = int(self.tree.cget("height"))
+        self.row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        self.visible_ids = []
+        if windowed:
+            self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self.yview)
+            self.tree.bind("<Configure>", self.on_resize)
+            self.tree.bind("<MouseWheel>", lambda event: self.scroll(-WHEEL_ROWS if event.delta > 0 else WHEEL_ROWS))
+            self.tree.bind("<Button-4>", lambda event: self.scroll(-WHEEL_ROWS))
+            self.tree.bind("<Button-5>", lambda event: self.scroll(WHEEL_ROWS))
+        else:
+            self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self.tree.yview)
+            self.tree.configure(yscrollcommand=self.scrollbar.set)
+
+    @staticmethod
+    def key(schedule):
+        return (schedule["date"], schedule["start_time"], schedule["id"])
+
+    @staticmethod
+    def values(schedule):
+        return (schedule["title"], schedule["date"], schedule["start_time"], schedule["end_time"])
+
+    def set_all(self):
+        self.key_by_id = {id: self.key(schedule) for id, schedule in self.schedules.items()}
+        self.keys = sorted(self.key_by_id.values())
+        if self.windowed:
+            self.render()
+            return
+        self.tree.delete(*self.tree.get_children())
+        for key in self.keys:
+            self.tree.insert("", tk.END, iid=str(key[2]), values=self.values(self.schedules[key[2]]))
+
+    def add(self, schedule):
+        key = self.key(schedule)
+        index = bisect.bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.key_by_id[schedule["id"]] = key
+        if self.windowed:
+            # 插入位置在视口之后时可见行不变
+            if index < self.offset + self.rows:
+                self.render()
+        else:
+            self.tree.insert("", index, iid=str(schedule["id"]), values=self.values(schedule))
+
+    def update(self, schedule):
+        old_index = bisect.bisect_left(self.keys, self.key_by_id[schedule["id"]])
+        del self.keys[old_index]
+        key = self.key(schedule)
+        index = bisect.bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.key_by_id[schedule["id"]] = key
+        if self.windowed:
+            # 新旧位置都在视口之前或都在视口之后时可见行不变
+            end = self.offset + self.rows
+            if not (max(old_index, index) < self.offset or min(old_index, index) >= end):
+                self.render()
+            return
+        iid = str(schedule["id"])
+        if index == old_index:
+            self.tree.item(iid, values=self.values(schedule))
+        else:
+            self.tree.delete(iid)
+            self.tree.insert("", index, iid=iid, values=self.values(schedule))
+
+    def remove(self, ids):
+        ids = [id for id in ids if id in self.key_by_id]
+        for id in ids:
+            del self.keys[bisect.bisect_left(self.keys, self.key_by_id.pop(id))]
+        if self.windowed:
+            self.render()
+        elif ids:
+            self.tree.delete(*[str(id) for id in ids])
+
+    def selected_ids(self):
+        if self.windowed:
+            return [self.visible_ids[self.tree.index(iid)] for iid in self.tree.selection()]
+        return [int(iid) for iid in self.tree.selection()]
+
+    def render(self):
+        # 复用已创建的行显示 [offset, offset + rows) 范围内的日程，并按 id 保留选中状态
+        selected = set(self.selected_ids())
+        self.offset = max(0, min(self.offset, len(self.keys) - self.rows))
+        visible = self.keys[self.offset:self.offset + self.rows]
+        children = self.tree.get_children()
+        for i, key in enumerate(visible):
+            values = self.values(self.schedules[key[2]])
+            if i < len(children):
+                self.tree.item(children[i], values=values)
+            else:
+                self.tree.insert("", tk.END, iid=f"row{i}", values=values)
+        if len(children) > len(visible):
+            self.tree.delete(*children[len(visible):])
+        self.visible_ids = [key[2] for key in visible]
+        self.tree.selection_set([f"row{i}" for i, id in enumerate(self.visible_ids) if id in selected])
+        total = len(self.keys)
+        if total:
+            self.scrollbar.set(self.offset / total, (self.offset + len(visible)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def yview(self, *args):
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.keys))
+        elif args[0] == "scroll":
+            self.offset += int(args[1]) * (self.rows if args[2] == "pages" else 1)
+        self.render()
+
+    def scroll(self, amount):
+        self.offset += amount
+        self.render()
+        return "break"
+
+    def on_resize(self, event):
+        # 减去表头占用的一行
+        rows = max(1, event.height // self.row_height - 1)
+        if rows != self.rows:
+            self.rows = rows
+            self.render()
+
 class ScheduleApp:
     def __init__(self, root):
         self.root = root
         self.root.title("日程计划应用")
         self.root.geometry("800x500")
         
-        # 创建数据存储文件
-        self.data_file = "schedule_data.json"
-        self.schedules = self.load_schedules()
+        # 创建数据存储，扩展名为 .db 时使用 SQLite
+        self.data_file = os.environ.get("SCHEDULE_DATA", "schedule_data.json")
+        self.store = open_store(self.data_file)
+        self.schedules = {schedule["id"]: schedule for schedule in self.load_schedules()}
         
         # 创建主框架
         self.main_frame = ttk.Frame(root, padding="10")
@@ -141,9 +284,11 @@ class ScheduleApp:
         ttk.Button(self.main_frame, text="添加日程", command=self.add_schedule).grid(row=4, column=0, columnspan=2, pady=10)
 
     def create_schedule_list(self):
-        # 创建树形视图
+        # 创建树形视图，日程较多时只创建视口内的行
         columns = ("标题", "日期", "开始时间", "结束时间")
-        self.tree = ttk.Treeview(self.main_frame, columns=columns, show="headings")
+        self.schedule_list = ScheduleList(self.main_frame, columns, self.schedules,
+                                          windowed=len(self.schedules) >= VIRTUAL_ROWS_THRESHOLD)
+        self.tree = self.schedule_list.tree
         
         # 设置列标题
         for col in columns:
@@ -153,9 +298,7 @@ class ScheduleApp:
         self.tree.grid(row=5, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
         
         # 添加滚动条
-        scrollbar = ttk.Scrollbar(self.main_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        scrollbar.grid(row=5, column=2, sticky=(tk.N, tk.S))
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.schedule_list.scrollbar.grid(row=5, column=2, sticky=(tk.N, tk.S))
         
         # 删除按钮
         ttk.Button(self.main_frame, text="删除选中", command=self.delete_schedule).grid(row=6, column=0, columnspan=2, pady=5)
@@ -164,7 +307,7 @@ class ScheduleApp:
         self.tree.bind("<Button-3>", self.show_context_menu)
         
         # 加载已有日程
-        self.refresh_schedule_list()
+        self.schedule_list.set_all()
 
     def create_context_menu(self):
         self.context_menu = tk.Menu(self.root, tearoff=0)
@@ -177,19 +320,19 @@ class ScheduleApp:
             self.context_menu.post(event.x_root, event.y_root)
 
     def edit_schedule(self):
-        selected_items = self.tree.selection()
-        if not selected_items:
+        selected_ids = self.schedule_list.selected_ids()
+        if not selected_ids:
             messagebox.showinfo("提示", "请先选择要编辑的日程")
             return
         
-        index = self.tree.index(selected_items[0])
-        schedule = self.schedules[index]
+        schedule = self.schedules[selected_ids[0]]
         
         dialog = EditDialog(self.root, schedule)
         if dialog.result:
-            self.schedules[index] = dialog.result
-            self.save_schedules()
-            self.refresh_schedule_list()
+            dialog.result["id"] = schedule["id"]
+            self.schedules[schedule["id"]] = dialog.result
+            self.store.put(dialog.result)
+            self.schedule_list.update(dialog.result)
 
     def add_schedule(self):
         title = self.title_entry.get().strip()
@@ -224,9 +367,9 @@ class ScheduleApp:
             "end_time": end_time
         }
         
-        self.schedules.append(schedule)
-        self.save_schedules()
-        self.refresh_schedule_list()
+        schedule["id"] = self.store.put(schedule)
+        self.schedules[schedule["id"]] = schedule
+        self.schedule_list.add(schedule)
         
         # 清空输入框
         self.title_entry.delete(0, tk.END)
@@ -238,78 +381,30 @@ class ScheduleApp:
         self.end_time_entry.insert(0, (datetime.now() + timedelta(hours=1)).strftime("%H:%M"))
 
     def delete_schedule(self):
-        selected_items = self.tree.selection()
-        if not selected_items:
+        selected_ids = self.schedule_list.selected_ids()
+        if not selected_ids:
             messagebox.showinfo("提示", "请先选择要删除的日程")
             return
         
-        for item in selected_items:
-            index = self.tree.index(item)
-            del self.schedules[index]
-        
-        self.save_schedules()
-        self.refresh_schedule_list()
-
-    def refresh_schedule_list(self):
-        # 清空列表
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        # 按日期和开始时间排序
-        sorted_schedules = sorted(self.schedules, key=lambda x: (x["date"], x["start_time"]))
-        
-        # 添加日程到列表
-        for schedule in sorted_schedules:
-            self.tree.insert("", tk.END, values=(
-                schedule["title"],
-                schedule["date"],
-                schedule["start_time"],
-                schedule["end_time"]
-            ))
+        # 一次遍历删除全部选中项，存储只写入一次
+        for id in selected_ids:
+            del self.schedules[id]
+        self.store.delete(selected_ids)
+        self.schedule_list.remove(selected_ids)
 
     def load_schedules(self):
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, "r", encoding="utf-8") as f:
-                    schedules = json.load(f)
-                    # 转换旧格式数据
-                    converted_schedules = []
-                    for schedule in schedules:
-                        if "datetime" in schedule:
-                            # 旧格式1：datetime字段
-                            dt = datetime.strptime(schedule["datetime"], "%Y-%m-%d %H:%M")
-                            converted_schedule = {
-                                "title": schedule["title"],
-                                "date": dt.strftime("%Y-%m-%d"),
-                                "start_time": dt.strftime("%H:%M"),
-                                "end_time": (dt + timedelta(hours=1)).strftime("%H:%M")
-                            }
-                        elif "date" in schedule and "time" in schedule:
-                            # 旧格式2：date和time字段
-                            dt = datetime.strptime(f"{schedule['date']} {schedule['time']}", "%Y-%m-%d %H:%M")
-                            converted_schedule = {
-                                "title": schedule["title"],
-                                "date": dt.strftime("%Y-%m-%d"),
-                                "start_time": dt.strftime("%H:%M"),
-                                "end_time": (dt + timedelta(hours=1)).strftime("%H:%M")
-                            }
-                        else:
-                            # 已经是新格式数据
-                            converted_schedule = schedule
-                        converted_schedules.append(converted_schedule)
-                    return converted_schedules
-            except:
-                return []
-        return []
-
-    def save_schedules(self):
-        with open(self.data_file, "w", encoding="utf-8") as f:
-            json.dump(self.schedules, f, ensure_ascii=False, indent=2)
+        try:
+            return self.store.load()
+        except StoreError as e:
+            # 数据文件损坏时不能当作空数据继续运行，否则之后的写入会覆盖原有数据
+            messagebox.showerror("错误", f"无法加载日程数据：{e}")
+            raise SystemExit(1)
 
 def main():
     root = tk.Tk()
     app = ScheduleApp(root)
     root.mainloop()
+    app.store.close()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""桌面版日程的存储后端
+
+JournalStore 把每次增删改作为一行 JSON 追加到操作日志，写入代价与日程总数
+无关；日志增长到一定长度后把全部日程写成快照（先写临时文件再原子替换），
+然后清空日志。启动时读取快照并重放日志，日志末尾因崩溃而不完整的一行会被
+丢弃。旧格式的数据只在第一次启动时转换并写回快照，快照旁的 .format 文件记录
+快照已是当前格式，之后启动不再逐条检查。SqliteStore 提供相同接口，数据保存在
+SQLite 数据库中。
+"""
+import json
+import os
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+# 日志操作数超过 max(COMPACT_MIN_OPS, 日程数) 时压缩为快照
+COMPACT_MIN_OPS = 1000
+# 读取快照时每次读入的字符数
+READ_CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+FIELDS = ("title", "date", "start_time", "end_time")
+# 快照格式版本：每条日程都有 id 和 title/date/start_time/end_time 字段
+FORMAT_VERSION = 1
+
+
+class StoreError(Exception):
+    pass
+
+
+def upgrade_record(schedule):
+    """把旧格式数据转换为 title/date/start_time/end_time 格式"""
+    if "datetime" in schedule:
+        # 旧格式1：datetime字段
+        dt = datetime.strptime(schedule["datetime"], "%Y-%m-%d %H:%M")
+    elif "date" in schedule and "time" in schedule:
+        # 旧格式2：date和time字段
+        dt = datetime.strptime(f"{schedule['date']} {schedule['time']}", "%Y-%m-%d %H:%M")
+    else:
+        # 已经是新格式数据
+        return schedule
+    record = {
+        "title": schedule["title"],
+        "date": dt.strftime("%Y-%m-%d"),
+        "start_time": dt.strftime("%H:%M"),
+        "end_time": (dt + timedelta(hours=1)).strftime("%H:%M")
+    }
+    if "id" in schedule:
+        record["id"] = schedule["id"]
+    return record
+
+
+def iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
+    """逐个产生文件中 JSON 数组的元素，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof, state = "", 0, False, "start"
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if pos < len(buffer):
+            char = buffer[pos]
+            if state == "start":
+                if char != "[":
+                    raise ValueError("Expecting JSON array")
+                pos, state = pos + 1, "first"
+                continue
+            if state in ("first", "next") and char == "]":
+                return
+            if state == "next":
+                if char != ",":
+                    raise ValueError("Expecting ',' delimiter")
+                pos, state = pos + 1, "item"
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # 恰好解析到缓冲区末尾时元素可能被截断（如数字），需要读入更多数据再确认
+                if end < len(buffer) or eof:
+                    yield item
+                    pos, state = end, "next"
+                    continue
+        elif eof:
+            raise ValueError("Unexpected end of JSON array")
+        more = f.read(chunk_size)
+        eof = not more
+        buffer, pos = buffer[pos:] + more, 0
+
+
+class ScheduleStore(ABC):
+    """存储后端接口；每条日程带有由存储分配的稳定 id"""
+
+    def __init__(self):
+        self.next_id = 1
+
+    @abstractmethod
+    def load(self):
+        """返回全部日程"""
+
+    @abstractmethod
+    def put(self, schedule):
+        """新增或替换一条日程；没有 id 时分配新 id，返回该 id"""
+
+    @abstractmethod
+    def delete(self, ids):
+        """一次删除多条日程"""
+
+    def close(self):
+        pass
+
+    def assign_id(self, schedule):
+        if "id" not in schedule:
+            schedule["id"] = self.next_id
+        self.next_id = max(self.next_id, schedule["id"] + 1)
+        return schedule["id"]
+
+
+class JournalStore(ScheduleStore):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.log_path = path + ".log"
+        self.format_path = path + ".format"
+        self.records = {}
+        self.log_ops = 0
+        self.log = None
+
+    def load(self):
+        upgraded = self._read_snapshot()
+        self._replay_log()
+        self.log = open(self.log_path, "a", encoding="utf-8")
+        if upgraded:
+            # 转换后的数据和刚分配的 id 需要写入快照，下次启动才能保持不变
+            self.compact()
+        return list(self.records.values())
+
+    def _read_snapshot(self):
+        """读取快照，返回是否有记录被转换或分配了 id"""
+        if not os.path.exists(self.path):
+            return False
+        current = self._snapshot_is_current()
+        upgraded = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for schedule in iter_json_array(f):
+                    if not current:
+                        record = upgrade_record(schedule)
+                        upgraded = upgraded or record is not schedule or "id" not in record
+                        schedule = record
+                    self.records[self.assign_id(schedule)] = schedule
+        except (OSError, ValueError, KeyError) as e:
+            raise StoreError(f"无法读取数据文件 {self.path}: {e}")
+        if not current and not upgraded:
+            self._mark_current()
+        return upgraded
+
+    def _snapshot_stat(self):
+        stat = os.stat(self.path)
+        return {"version": FORMAT_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _snapshot_is_current(self):
+        # 快照被替换或修改过（大小或修改时间不同）时需要重新检查
+        try:
+            with open(self.format_path, "r", encoding="utf-8") as f:
+                return json.load(f) == self._snapshot_stat()
+        except (OSError, ValueError):
+            return False
+
+    def _mark_current(self):
+        with open(self.format_path, "w", encoding="utf-8") as f:
+            json.dump(self._snapshot_stat(), f)
+
+    def _replay_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        valid_size = 0
+        with open(self.log_path, "r+b") as f:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        if not line.endswith(b"\n"):
+                            # 最后一行没写完就崩溃了，丢弃它
+                            break
+                        raise StoreError(f"操作日志 {self.log_path} 第 {number} 行已损坏")
+                    self._apply(entry)
+                    self.log_ops += 1
+                valid_size += len(line)
+            f.truncate(valid_size)
+
+    def _apply(self, entry):
+        if entry["op"] == "put":
+            schedule = entry["schedule"]
+            self.records[self.assign_id(schedule)] = schedule
+        else:
+            for id in entry["ids"]:
+                self.records.pop(id, None)
+
+    def _append(self, entry):
+        self.log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_ops += 1
+        if self.log_ops > max(COMPACT_MIN_OPS, len(self.records)):
+            self.compact()
+
+    def put(self, schedule):
+        schedule = dict(schedule)
+        id = self.assign_id(schedule)
+        self.records[id] = schedule
+        self._append({"op": "put", "schedule": schedule})
+        return id
+
+    def delete(self, ids):
+        ids = [id for id in ids if id in self.records]
+        if not ids:
+            return
+        for id in ids:
+            del self.records[id]
+        self._append({"op": "delete", "ids": ids})
+
+    def compact(self):
+        """把当前全部日程写成快照并清空日志"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self.records.values()), f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # 在这里崩溃时格式记录与快照不符，下次启动只是多检查一遍
+        self._mark_current()
+        # 快照替换之后、日志清空之前崩溃也没关系：按 id 重放日志的结果不变
+        self.log.truncate(0)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.log_ops = 0
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class SqliteStore(ScheduleStore):
+    def __init__(self, path):
+        super().__init__()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS schedule ("
+            "id INTEGER PRIMARY KEY, title TEXT NOT NULL, date TEXT NOT NULL, "
+            "start_time TEXT NOT NULL, end_time TEXT NOT NULL)")
+
+    def load(self):
+        rows = self.conn.execute(f"SELECT id, {', '.join(FIELDS)} FROM schedule")
+        schedules = [dict(zip(("id",) + FIELDS, row)) for row in rows]
+        for schedule in schedules:
+            self.assign_id(schedule)
+        return schedules
+
+    def put(self, schedule):
+        schedule = dict(schedule)
+        id = self.assign_id(schedule)
+        with self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO schedule (id, {', '.join(FIELDS)}) VALUES (?, ?, ?, ?, ?)",
+                (id,) + tuple(schedule[field] for field in FIELDS))
+        return id
+
+    def delete(self, ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM schedule WHERE id = ?", [(id,) for id in ids])
+
+    def close(self):
+        self.conn.close()
+
+
+def open_store(path):
+    """按文件扩展名选择后端：.db / .sqlite 使用 SQLite，其它使用快照加操作日志"""
+    if os.path.splitext(path)[1] in (".db", ".sqlite", ".sqlite3"):
+        return SqliteStore(path)
+    return JournalStore(path)
@@ -0,0 +1,48 @@
+"""日程标题全文检索的分词
+
+中文、日文等不用空格分词的文字按单字和相邻两字（bigram）切分，其它文字按词
+切分。索引时把标题转换为以空格分隔的词元交给 SQLite FTS5 的 unicode61 分词器；
+查询时按同样规则切分，要求所有词元都出现。三个字以上的连续汉字由多个 bigram
+组成，词元都出现不代表原文连续，调用方需再按原文片段过滤。
+"""
+import re
+
+# 假名、CJK 统一汉字（含扩展 A）、兼容汉字和谚文音节
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+# 一段连续的 CJK 字符，或一个不含 CJK 字符的词
+TOKEN = re.compile(f'([{CJK}]+)|([^\\W_{CJK}]+)')
+
+
+def bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def index_terms(title):
+    """标题的索引词元：每个汉字、相邻两字和其它文字的词"""
+    terms = []
+    for run, word in TOKEN.findall(title or ''):
+        if run:
+            terms.extend(run)
+            terms.extend(bigrams(run))
+        else:
+            terms.append(word)
+    return ' '.join(terms)
+
+
+def parse_query(query):
+    """返回 (FTS5 查询表达式, 需要按原文匹配的片段, 搜索词中的词和连续汉字)
+
+    没有可检索的字符时表达式为 None。非 CJK 的词按前缀匹配。
+    """
+    terms, fragments, tokens = [], [], []
+    for run, word in TOKEN.findall(query):
+        if run:
+            terms.extend(bigrams(run) if len(run) > 1 else [run])
+            if len(run) > 2:
+                fragments.append(run)
+        else:
+            terms.append(f'"{word}"*')
+            word = word.lower()
+        tokens.append(run or word)
+    terms = [term if term.endswith('*') else f'"{term}"' for term in dict.fromkeys(terms)]
+    return (' AND '.join(terms) or None), fragments, tokens
@@ -0,0 +1,556 @@
+"""路由测试：同一组断言分别通过 Flask 测试客户端（WSGI 部署）和包装同一应用的 asgi.ScheduleApp（ASGI 部署）执行；
+应用与 gunicorn 入口一样由 create_app() 创建"""
+import asyncio
+import http.client
+import itertools
+import json
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from urllib.parse import urlsplit
+
+import pytest
+
+import app as app_module
+import asgi
+
+
+class Result:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def json(self):
+        return json.loads(self.body)
+
+
+class FlaskClient:
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        # bytes 原样作为请求体发送（Content-Type 由 headers 给出），其它值编码为 JSON
+        raw = isinstance(body, bytes)
+        response = self.client.open(path, method=method, data=body if raw else None, json=None if raw else body,
+                                    headers=headers or {})
+        return Result(response.status_code, {name.lower(): value for name, value in response.headers},
+                      response.get_data())
+
+
+class AsgiClient:
+    """逐个请求在新的事件循环中调用 ASGI 应用"""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    def request(self, method, path, body=None, headers=None):
+        return asyncio.run(self.call(method, path, body, headers or {}))
+
+    async def call(self, method, path, body, headers):
+        url = urlsplit(path)
+        headers = {name.lower(): value for name, value in headers.items()}
+        data = b''
+        if isinstance(body, bytes):
+            data = body
+        elif body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['content-type'] = 'application/json'
+        headers['content-length'] = str(len(data))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'path': url.path, 'raw_path': url.path.encode('latin-1'),
+            'query_string': url.query.encode('latin-1'), 'root_path': '',
+            'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        messages = [{'type': 'http.request', 'body': data, 'more_body': False}]
+        disconnected = asyncio.Event()
+        status, response_headers, chunks = None, {}, []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                response_headers.update((name.decode('latin-1').lower(), value.decode('latin-1'))
+                                        for name, value in message.get('headers', []))
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    disconnected.set()
+
+        await self.app(scope, receive, send)
+        return Result(status, response_headers, b''.join(chunks))
+
+
+@pytest.fixture(scope='session')
+def flask_app(tmp_path_factory):
+    database = tmp_path_factory.mktemp('db') / 'test.db'
+    flask_app = app_module.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}'})
+    with flask_app.app_context():
+        app_module.upgrade_schema()
+    return flask_app
+
+
+@pytest.fixture(scope='session')
+def asgi_app(flask_app):
+    return asgi.ScheduleApp(flask_app)
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def client(request, flask_app, asgi_app):
+    return FlaskClient(flask_app) if request.param == 'wsgi' else AsgiClient(asgi_app)
+
+
+@pytest.fixture
+def token(flask_app):
+    # 每个测试使用一个新用户，互不影响
+    return new_user(flask_app)
+
+
+def new_user(flask_app):
+    # 与 flask create-user 相同地创建用户和变更计数器，返回令牌
+    token = secrets.token_urlsafe(16)
+    with flask_app.app_context():
+        user = app_module.User(name=token, token_hash=app_module.hash_token(token))
+        app_module.db.session.add(user)
+        app_module.db.session.flush()
+        app_module.db.session.add(app_module.ChangeCounter(name=app_module.counter_name(user.id), value=0))
+        app_module.db.session.commit()
+    return token
+
+
+@pytest.fixture
+def api(client, token):
+    def request(method, path, body=None, headers=None):
+        return client.request(method, path, body, dict(headers or {}, Authorization=f'Bearer {token}'))
+    return request
+
+
+def schedule(title='Meeting', date='2024-03-01', start='09:00', end='10:00', **extra):
+    return dict(title=title, date=date, start_time=start, end_time=end, **extra)
+
+
+def test_create_get_update_delete(api):
+    created = api('POST', '/api/schedules', schedule())
+    assert created.status == 201
+    id = created.json['id']
+
+    fetched = api('GET', f'/api/schedules/{id}')
+    assert fetched.status == 200
+    assert fetched.json['title'] == 'Meeting'
+
+    updated = api('PUT', f'/api/schedules/{id}', schedule(title='Review'))
+    assert updated.status == 200
+    assert api('GET', f'/api/schedules/{id}').json['title'] == 'Review'
+
+    assert api('DELETE', f'/api/schedules/{id}').status == 204
+    assert api('GET', f'/api/schedules/{id}').status == 404
+
+
+def test_list_is_scoped_to_owner(api, client):
+    api('POST', '/api/schedules', schedule(title='Mine'))
+    listed = api('GET', '/api/schedules?from=2024-03-01&to=2024-03-01')
+    assert [item['title'] for item in listed.json] == ['Mine']
+    assert client.request('GET', '/api/schedules?token=invalid').status == 401
+
+
+def test_not_modified(api):
+    api('POST', '/api/schedules', schedule())
+    first = api('GET', '/api/schedules')
+    assert first.headers.get('etag')
+    again = api('GET', '/api/schedules', headers={'If-None-Match': first.headers['etag']})
+    assert again.status == 304
+
+
+def test_validation_error(api):
+    response = api('POST', '/api/schedules', schedule(start='10:00', end='09:00'))
+    assert response.status == 400
+    assert 'error' in response.json
+
+
+def test_migrate_pads_legacy_values(tmp_path):
+    # 旧版本按原样保存字符串；迁移后应补零，游标分页才能按日期、时间顺序走完且不重复
+    database = tmp_path / 'legacy.db'
+    with sqlite3.connect(database) as conn:
+        conn.execute('CREATE TABLE schedule (id INTEGER PRIMARY KEY, title VARCHAR(100) NOT NULL, '
+                     'date VARCHAR(10) NOT NULL, start_time VARCHAR(5) NOT NULL, end_time VARCHAR(5) NOT NULL, '
+                     'reminder_time VARCHAR(5))')
+        conn.executemany('INSERT INTO schedule VALUES (?, ?, ?, ?, ?, ?)', [
+            (1, 'Late', '2024-03-01', '10:00', '11:00', ''),
+            (2, 'Early', '2024-3-1', '9:05', '9:30', '9:00'),
+            (3, 'Next', '2024-03-2', '8:00', '09:00', None),
+        ])
+    legacy_app = app_module.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database}'})
+    with legacy_app.app_context():
+        app_module.upgrade_schema()
+    with sqlite3.connect(database) as conn:
+        assert conn.execute('SELECT date, start_time, end_time, reminder_time, remind_at FROM schedule '
+                            'WHERE id = 2').fetchone() == ('2024-03-01', '09:05', '09:30', '09:00', '2024-03-01 09:00')
+        assert conn.execute('SELECT reminder_time FROM schedule WHERE id = 1').fetchone() == (None,)
+
+    client = FlaskClient(legacy_app)
+    ids, cursor = [], None
+    for _ in range(5):
+        page = client.request('GET', '/api/schedules?from=2024-03-01&to=2024-03-02&limit=1'
+                              + (f'&cursor={cursor}' if cursor else ''))
+        ids += [item['id'] for item in page.json]
+        cursor = page.headers.get('x-next-cursor')
+        if not cursor:
+            break
+    assert ids == [2, 1, 3]
+
+
+def test_changes(api):
+    seq = api('GET', '/api/changes').json['seq']
+    id = api('POST', '/api/schedules', schedule()).json['id']
+    changes = api('GET', f'/api/changes?since={seq}').json
+    assert changes['seq'] > seq
+    assert [change['id'] for change in changes['changes']] == [id]
+
+
+def test_long_poll_times_out_without_changes(api, client):
+    seq = api('GET', '/api/changes').json['seq']
+    started = time.monotonic()
+    response = api('GET', f'/api/changes?since={seq}&wait=1')
+    assert response.status == 200
+    assert response.json == {'seq': seq, 'changes': []}
+    assert time.monotonic() - started >= 0.9
+    # 只有 ASGI 部署提示网页改用 Server-Sent Events
+    assert (response.headers.get('x-change-stream') == 'sse') == isinstance(client, AsgiClient)
+
+
+def test_stream_does_not_resend_changes(api, flask_app, token, monkeypatch):
+    # 读取计数器之后才提交的变更已随本轮发出，下一轮不应再次发送
+    seq = api('GET', '/api/changes').json['seq']
+    first = api('POST', '/api/schedules', schedule()).json['id']
+    second = api('POST', '/api/schedules', schedule(title='Later')).json['id']
+    counter = iter([seq + 1, seq + 2, seq + 2])
+    monkeypatch.setattr(app_module, 'wait_for_change', lambda since, timeout: next(counter))
+    with flask_app.app_context():
+        app_module.g.owner_id = app_module.token_owner(token)
+        events = [event for event in itertools.islice(app_module.stream_changes(seq), 4) if event.startswith('id:')]
+    assert [json.loads(event.partition('data: ')[2])['id'] for event in events] == [first, second]
+
+
+def test_long_poll_requires_valid_token(client):
+    assert client.request('GET', '/api/changes?wait=1&token=invalid').status == 401
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_long_poll_on_reused_connection(asgi_app, token):
+    # 上一个响应结束时启动的 keep-alive 计时器不能中断同一连接上紧接着的长轮询
+    uvicorn = pytest.importorskip('uvicorn')
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port, timeout_keep_alive=1,
+                                           lifespan='off', log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        while not server.started:
+            time.sleep(0.05)
+        headers = {'Authorization': f'Bearer {token}'}
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        for _ in range(3):
+            connection.request('GET', '/api/changes', headers=headers)
+            seq = json.loads(connection.getresponse().read())['seq']
+            connection.request('GET', f'/api/changes?since={seq}&wait=2', headers=headers)
+            response = connection.getresponse()
+            assert response.status == 200
+            assert json.loads(response.read()) == {'seq': seq, 'changes': []}
+        connection.close()
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def test_last_event_id_overrides_since(api):
+    # EventSource 重连时 URL 不变，应从 Last-Event-ID 继续
+    api('POST', '/api/schedules', schedule())
+    seq = api('GET', '/api/changes').json['seq']
+    id = api('POST', '/api/schedules', schedule(title='Later')).json['id']
+    changes = api('GET', '/api/changes?since=0', headers={'Last-Event-ID': str(seq)}).json['changes']
+    assert [change['id'] for change in changes] == [id]
+
+    started = time.monotonic()
+    response = api('GET', '/api/changes?since=0&wait=1', headers={'Last-Event-ID': str(seq + 1)})
+    assert response.json['changes'] == []
+    assert time.monotonic() - started >= 0.9
+
+
+def test_batch(api):
+    existing = api('POST', '/api/schedules', schedule(title='Old')).json['id']
+    response = api('POST', '/api/schedules/batch', [
+        {'op': 'create', 'data': schedule(title='A')},
+        {'op': 'update', 'id': existing, 'data': schedule(title='Renamed')},
+        {'op': 'create', 'data': schedule(title='B', start='11:00', end='12:00')},
+    ])
+    assert response.status == 200
+    results = response.json['results']
+    assert [result['status'] for result in results] == [201, 200, 201]
+    for result in results:
+        fetched = api('GET', f"/api/schedules/{result['schedule']['id']}").json
+        assert fetched['title'] == result['schedule']['title']
+
+
+def test_empty_batch_keeps_seq(api):
+    seq = api('GET', '/api/changes').json['seq']
+    response = api('POST', '/api/schedules/batch', [])
+    assert response.json == {'seq': seq, 'results': []}
+    assert api('GET', '/api/changes').json['seq'] == seq
+
+
+def test_recurring_conflicts(api):
+    api('POST', '/api/schedules', schedule(title='Standup', date='2024-03-15'))
+    weekly = schedule(title='Weekly', date='2024-03-01', recurrence={'freq': 'weekly', 'count': 4})
+    response = api('POST', '/api/schedules?conflicts=reject', weekly)
+    assert response.status == 409
+    assert [(item['title'], item['date']) for item in response.json['conflicts']] == [('Standup', '2024-03-15')]
+
+    id = api('POST', '/api/schedules', dict(weekly, date='2024-03-02')).json['id']
+    single = api('POST', '/api/schedules?conflicts=warn', schedule(title='Single', date='2024-03-16')).json
+    assert [(item['id'], item['date']) for item in single['conflicts']] == [(id, '2024-03-16')]
+    moved = api('PUT', f'/api/schedules/{id}?conflicts=reject', dict(weekly, date='2024-03-03'))
+    assert moved.status == 200
+
+
+def test_stats_window_follows_today(api, monkeypatch):
+    # 未给出 to 时默认窗口截止到今天，跨天后不能返回前一天缓存的结果
+    class Clock(datetime):
+        today = datetime(2024, 3, 10, 12, 0)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.today
+
+    monkeypatch.setattr(app_module, 'datetime', Clock)
+    api('POST', '/api/schedules', schedule(date='2024-03-11'))
+    first = api('GET', '/api/stats')
+    assert (first.json['to'], first.json['total_minutes']) == ('2024-03-10', 0)
+
+    Clock.today = datetime(2024, 3, 11, 12, 0)
+    second = api('GET', '/api/stats', headers={'If-None-Match': first.headers['etag']})
+    assert second.status == 200
+    assert (second.json['to'], second.json['total_minutes']) == ('2024-03-11', 60)
+
+
+def archive(flask_app, before):
+    with flask_app.app_context():
+        return app_module.archive_schedules(before)
+
+
+def test_rebuild_stats_includes_archive(api, flask_app):
+    api('POST', '/api/schedules', schedule(date='2020-01-06'))
+    api('POST', '/api/schedules', schedule(date='2020-01-07', start='09:00', end='11:00'))
+    window = '/api/stats?from=2020-01-01&to=2020-01-31'
+    before = api('GET', window).json
+    assert before['total_minutes'] == 180
+    archive(flask_app, date(2020, 1, 7))
+    result = flask_app.test_cli_runner().invoke(args=['rebuild-stats'])
+    assert result.exit_code == 0
+    # 换一个 URL，不使用归档前缓存的响应
+    after = api('GET', window + '&rebuilt=1').json
+    assert (after['total_minutes'], after['days'], after['titles']) == \
+        (before['total_minutes'], before['days'], before['titles'])
+
+
+def test_archive_updates_running_indexes(api, flask_app):
+    id = api('POST', '/api/schedules', schedule(date='2020-01-06')).json['id']
+    archive(flask_app, date(2020, 1, 7))
+    seq = api('GET', '/api/changes').json['seq']
+    # 区间索引和日历快照在日程已归档时建立；已归档的日程同样参与冲突检测和空闲时段计算
+    conflicts = '/api/schedules/conflicts?date=2020-01-06&start=09:00&end=10:00'
+    assert [item['id'] for item in api('GET', conflicts).json] == [id]
+    assert api('GET', '/api/calendar.ics').body.count(b'BEGIN:VEVENT') == 1
+    clash = api('POST', '/api/schedules?conflicts=reject', schedule(date='2020-01-06', start='09:30', end='10:30'))
+    assert clash.status == 409
+
+    archive(flask_app, date(2020, 1, 1))
+    assert [item['id'] for item in api('GET', conflicts).json] == [id]
+    assert api('GET', '/api/calendar.ics').body.count(b'BEGIN:VEVENT') == 1
+    changes = api('GET', f'/api/changes?since={seq}').json['changes']
+    assert [(change['id'], change['date']) for change in changes] == [(id, '2020-01-06')]
+
+    archive(flask_app, date(2020, 1, 7))
+    free = api('GET', '/api/free-slots?from=2020-01-06&to=2020-01-06&day_start=09:00&day_end=11:00&duration=60').json
+    assert [(slot['start_time'], slot['end_time']) for slot in free] == [('10:00', '11:00')]
+    other = api('POST', '/api/schedules', schedule(date='2020-01-06', start='09:30', end='10:30')).json['id']
+    assert [[item['id'] for item in group] for group in
+            api('GET', '/api/schedules/conflicts?date=2020-01-06').json] == [[id, other]]
+
+
+def test_calendar_includes_archived(api, flask_app):
+    id = api('POST', '/api/schedules', schedule(title='Old', date='2020-01-06')).json['id']
+    api('POST', '/api/schedules', schedule(title='Recent', date='2030-01-06'))
+    archive(flask_app, date(2020, 1, 7))
+    body = api('GET', '/api/calendar.ics').body
+    assert b'SUMMARY:Old' in body and b'SUMMARY:Recent' in body
+
+    # 修改已归档的日程先将其移回日程表，之后再次归档
+    api('PUT', f'/api/schedules/{id}', schedule(title='Renamed', date='2020-01-06'))
+    archive(flask_app, date(2020, 1, 7))
+    body = api('GET', '/api/calendar.ics').body
+    assert b'SUMMARY:Old' not in body and body.count(b'SUMMARY:Renamed') == 1
+    assert b'SUMMARY:Renamed' not in api('GET', '/api/calendar.ics?from=2029-01-01').body
+
+    api('DELETE', f'/api/schedules/{id}')
+    assert b'SUMMARY:Renamed' not in api('GET', '/api/calendar.ics').body
+
+
+def test_apps_do_not_share_state(flask_app):
+    strict = app_module.create_app({'SQLALCHEMY_DATABASE_URI': flask_app.config['SQLALCHEMY_DATABASE_URI'],
+                                    'REQUIRE_AUTH': True})
+    assert strict.test_client().get('/api/schedules').status_code == 401
+    assert flask_app.test_client().get('/api/schedules').status_code == 200
+    counted = b'route="/api/schedules",status="200"'
+    assert counted in flask_app.test_client().get('/metrics').data
+    assert counted not in strict.test_client().get('/metrics').data
+
+
+def test_slow_request_log_hides_token(flask_app, token, caplog):
+    logged = app_module.create_app({'SQLALCHEMY_DATABASE_URI': flask_app.config['SQLALCHEMY_DATABASE_URI'],
+                                    'SLOW_REQUEST_SECONDS': 0})
+    assert logged.test_client().get(f'/api/calendar.ics?token={token}&from=2024-01-01').status_code == 200
+    messages = [record.getMessage() for record in caplog.records if 'Slow request' in record.getMessage()]
+    assert messages and 'token=REDACTED&from=2024-01-01' in messages[0]
+    assert token not in ''.join(messages)
+
+
+def test_free_slots_until_end_of_day(api):
+    api('POST', '/api/schedules', schedule(date='2024-05-01', start='20:00', end='22:00'))
+    slots = api('GET', '/api/free-slots?from=2024-05-01&to=2024-05-01&day_start=18:00&day_end=24:00&duration=60')
+    assert slots.status == 200
+    assert [(slot['start_time'], slot['end_time'], slot['minutes']) for slot in slots.json] == \
+        [('18:00', '20:00', 120), ('22:00', '24:00', 120)]
+    # 不给出 day_end 时同样到 24:00 为止，返回的结束时刻可原样作为 day_end
+    default = api('GET', '/api/free-slots?from=2024-05-01&to=2024-05-01&day_start=18:00&duration=60')
+    assert default.json == slots.json
+    assert api('GET', '/api/free-slots?from=2024-05-01&to=2024-05-01&day_end=24:30&duration=60').status == 400
+
+
+def test_due_reminders_follow_client_clock(api):
+    # 提醒时间是客户端本地钟点，是否到期按请求中的 now 判断，而不是服务器时钟
+    single = api('POST', '/api/schedules', schedule(date='2031-06-01', reminder_time='08:30')).json['id']
+    daily = api('POST', '/api/schedules', schedule(title='Standup', date='2031-05-01', start='10:00', end='10:15',
+                                                   reminder_time='09:55', recurrence={'freq': 'daily'})).json['id']
+
+    early = api('GET', '/api/reminders/due?now=2031-06-01T08:29')
+    assert early.json['reminders'] == []
+    assert (early.json['next_due'], early.json['next_due_in']) == ('2031-06-01 08:30', 60)
+
+    due = api('GET', '/api/reminders/due?now=2031-06-01T08:30&since=2031-06-01T08:29')
+    assert [item['id'] for item in due.json['reminders']] == [single]
+    assert due.json['until'] == '2031-06-01 08:30'
+    assert due.json['next_due'] == '2031-06-01 09:55'
+
+    recurring = api('GET', f"/api/reminders/due?now=2031-06-01T10:00&since={due.json['until']}")
+    assert [(item['id'], item['date']) for item in recurring.json['reminders']] == [(daily, '2031-06-01')]
+    assert api('GET', '/api/reminders/due?now=tomorrow').status == 400
+
+
+def test_search_pages_through_every_match(api):
+    # 匹配很多的常见词同样在全部匹配上排序，翻页直到取完每一条
+    operations = [{'op': 'create', 'data': schedule(title=f'Weekly sync {number}')} for number in range(600)]
+    created = {result['schedule']['id'] for result in api('POST', '/api/schedules/batch', operations).json['results']}
+    seen, cursor = [], None
+    while True:
+        page = api('GET', '/api/schedules/search?q=sync&limit=250' + (f'&cursor={cursor}' if cursor else ''))
+        seen += [item['id'] for item in page.json]
+        cursor = page.headers.get('x-next-cursor')
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 600
+    assert set(seen) == created
+
+
+def test_list_cursor_pagination(api):
+    # 按 (date, start_time, id) 翻页：同一时刻的日程按 id 区分，翻页途中插入到已读位置之前的日程不影响后续页
+    ids = [api('POST', '/api/schedules', schedule(date=day, start=start, end='23:00')).json['id']
+           for day, start in [('2024-07-02', '09:00'), ('2024-07-01', '10:00'), ('2024-07-01', '09:00'),
+                              ('2024-07-01', '09:00'), ('2024-07-03', '08:00')]]
+    window = '/api/schedules?from=2024-07-01&to=2024-07-03&limit=2'
+    first = api('GET', window)
+    assert [item['id'] for item in first.json] == [ids[2], ids[3]]
+    api('POST', '/api/schedules', schedule(date='2024-07-01', start='08:00'))
+    seen, cursor = [item['id'] for item in first.json], first.headers['x-next-cursor']
+    while cursor:
+        page = api('GET', f'{window}&cursor={cursor}')
+        seen += [item['id'] for item in page.json]
+        cursor = page.headers.get('x-next-cursor')
+    assert seen == [ids[2], ids[3], ids[1], ids[0], ids[4]]
+    assert api('GET', f'{window}&cursor=garbage').status == 400
+
+
+def test_free_slots(api):
+    # 单次日程和重复日程都占用时间，短于 duration 的空隙不返回
+    api('POST', '/api/schedules', schedule(date='2024-08-05', start='09:00', end='10:00'))
+    api('POST', '/api/schedules', schedule(date='2024-08-05', start='10:20', end='12:00'))
+    api('POST', '/api/schedules', schedule(date='2024-08-05', start='13:00', end='14:00',
+                                           recurrence={'freq': 'daily', 'count': 2}))
+    slots = api('GET', '/api/free-slots?from=2024-08-05&to=2024-08-07&day_start=09:00&day_end=15:00&duration=60')
+    assert [(slot['date'], slot['start_time'], slot['end_time']) for slot in slots.json] == [
+        ('2024-08-05', '12:00', '13:00'), ('2024-08-05', '14:00', '15:00'),
+        ('2024-08-06', '09:00', '13:00'), ('2024-08-06', '14:00', '15:00'),
+        ('2024-08-07', '09:00', '15:00'),
+    ]
+    assert api('GET', '/api/free-slots?from=2024-08-07&to=2024-08-05&duration=60').status == 400
+
+
+def test_export_import_round_trip(api, client, flask_app):
+    # 导出后导入到另一个用户，两种格式都应得到相同的日程（id 除外）
+    api('POST', '/api/schedules', schedule(title='Dentist', date='2024-09-02', reminder_time='08:45'))
+    api('POST', '/api/schedules', schedule(title='周会', date='2024-09-03', start='14:00', end='15:00',
+                                           recurrence={'freq': 'weekly', 'until': '2024-10-01',
+                                                       'exdates': ['2024-09-17']}))
+
+    def exported(request):
+        lines = request('GET', '/api/schedules/export').body.decode('utf-8').splitlines()
+        return [dict(json.loads(line), id=None) for line in lines]
+
+    original = exported(api)
+    assert [item['title'] for item in original] == ['Dentist', '周会']
+    for export_format, content_type in [('ndjson', 'application/x-ndjson'), ('ics', 'text/calendar')]:
+        body = api('GET', f'/api/schedules/export?format={export_format}').body
+        headers = {'Authorization': f'Bearer {new_user(flask_app)}', 'Content-Type': content_type}
+
+        def other(method, path, body=None):
+            return client.request(method, path, body, headers)
+
+        result = other('POST', '/api/schedules/import', body)
+        assert result.json['imported'] == 2 and result.json['skipped'] == 0, export_format
+        assert exported(other) == original, export_format
+
+
+def test_search_ranking_and_pagination(api):
+    # 相关度高的排在前面，逐页读取与一次读取的顺序相同；多个词须同时出现
+    titles = ['Kickoff meeting with the whole department about the new project roadmap',
+              'Project kickoff', 'Project kickoff prep', 'Project status']
+    ids = {title: api('POST', '/api/schedules', schedule(title=title)).json['id'] for title in titles}
+    everything = api('GET', '/api/schedules/search?q=project kickoff').json
+    assert [item['title'] for item in everything][0] == 'Project kickoff'
+    assert {item['id'] for item in everything} == {ids[title] for title in titles[:3]}
+
+    paged, cursor = [], None
+    while True:
+        page = api('GET', '/api/schedules/search?q=project kickoff&limit=1' + (f'&cursor={cursor}' if cursor else ''))
+        paged += page.json
+        cursor = page.headers.get('x-next-cursor')
+        if not cursor:
+            break
+    assert paged == everything
+    assert api('GET', '/api/schedules/search?q=').status == 400
@@ -0,0 +1,140 @@
+"""日程字段的解析与校验
+
+每个字段只解析一次，直接得到 date/time 对象写入数据库；解析结果按原始字符串
+缓存，批量校验时大量重复的日期、时间字符串只需解析一次。
+"""
+import re
+from datetime import date, datetime, time
+from functools import lru_cache
+
+from recurrence import FREQUENCIES, Rule, last_occurrence
+
+DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})\Z')
+TIME_RE = re.compile(r'(\d{1,2}):(\d{1,2})\Z')
+MAX_RECURRENCE_COUNT = 1000
+MAX_RECURRENCE_INTERVAL = 366
+
+
+class ValidationError(ValueError):
+    pass
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(value):
+    match = DATE_RE.match(value)
+    if not match:
+        raise ValidationError('Invalid date or time format')
+    try:
+        return date(*map(int, match.groups()))
+    except ValueError:
+        raise ValidationError('Invalid date or time format')
+
+
+@lru_cache(maxsize=2048)
+def _parse_time(value):
+    match = TIME_RE.match(value)
+    if not match:
+        raise ValidationError('Invalid date or time format')
+    try:
+        return time(*map(int, match.groups()))
+    except ValueError:
+        raise ValidationError('Invalid date or time format')
+
+
+def parse_date(value):
+    if not isinstance(value, str):
+        raise ValidationError('Invalid date or time format')
+    return _parse_date(value)
+
+
+def parse_time(value):
+    if not isinstance(value, str):
+        raise ValidationError('Invalid date or time format')
+    return _parse_time(value)
+
+
+def parse_datetime(value):
+    # 接受 "YYYY-MM-DD HH:MM" 或 "YYYY-MM-DDTHH:MM"
+    if not isinstance(value, str):
+        raise ValidationError('Invalid date or time format')
+    day, sep, clock = value.replace('T', ' ').partition(' ')
+    if not sep:
+        raise ValidationError('Invalid date or time format')
+    return datetime.combine(parse_date(day), parse_time(clock))
+
+
+def parse_recurrence(data, start):
+    """校验重复规则，返回写入 Schedule 的 recur_* 字段；data 为空表示不重复。"""
+    if not data:
+        return {'recur_freq': None, 'recur_interval': None, 'recur_count': None,
+                'recur_until': None, 'recur_exdates': None, 'recur_end': None}
+    if not isinstance(data, dict) or data.get('freq') not in FREQUENCIES:
+        raise ValidationError(f"Recurrence freq must be one of {', '.join(FREQUENCIES)}")
+    interval = data.get('interval', 1)
+    count = data.get('count')
+    if not isinstance(interval, int) or not 1 <= interval <= MAX_RECURRENCE_INTERVAL:
+        raise ValidationError('Invalid recurrence interval')
+    if count is not None and (not isinstance(count, int) or not 1 <= count <= MAX_RECURRENCE_COUNT):
+        raise ValidationError(f'Recurrence count must be between 1 and {MAX_RECURRENCE_COUNT}')
+    until = parse_date(data['until']) if data.get('until') else None
+    if until is not None and until < start:
+        raise ValidationError('Recurrence until must not be earlier than date')
+    exdates = data.get('exdates') or []
+    if not isinstance(exdates, list):
+        raise ValidationError('Recurrence exdates must be a list of dates')
+    exdates = tuple(sorted(set(parse_date(day) for day in exdates)))
+
+    rule = Rule(start, data['freq'], interval, count, until, exdates)
+    return {
+        'recur_freq': rule.freq,
+        'recur_interval': rule.interval,
+        'recur_count': rule.count,
+        'recur_until': rule.until,
+        'recur_exdates': ','.join(day.isoformat() for day in exdates) or None,
+        'recur_end': last_occurrence(rule),
+    }
+
+
+def parse_schedule(data):
+    """校验一条日程数据，返回可直接写入 Schedule 的字段；不合法时抛出 ValidationError。"""
+    if not isinstance(data, dict):
+        raise ValidationError('Missing data')
+    for field in ('title', 'date', 'start_time', 'end_time'):
+        if field not in data:
+            raise ValidationError(f"Missing or invalid field: '{field}'")
+    if data['title'] is None:
+        raise ValidationError('Title is required')
+
+    day = parse_date(data['date'])
+    start_time = parse_time(data['start_time'])
+    end_time = parse_time(data['end_time'])
+    reminder_time = parse_time(data['reminder_time']) if data.get('reminder_time') else None
+    if end_time <= start_time:
+        raise ValidationError('End time must be later than start time')
+
+    recurrence = parse_recurrence(data.get('recurrence'), day)
+
+    fields = {
+        'title': data['title'],
+        'date': day,
+        'start_time': start_time,
+        'end_time': end_time,
+        'reminder_time': reminder_time,
+        # 重复日程的提醒按发生日期计算，不使用 remind_at 索引
+        'remind_at': datetime.combine(day, reminder_time) if reminder_time and not recurrence['recur_freq'] else None,
+    }
+    fields.update(recurrence)
+    return fields
+
+
+def parse_schedules(items):
+    """一次遍历校验一批日程数据，返回 (字段列表, 错误列表)，两者与输入一一对应。"""
+    rows, errors = [], []
+    for data in items:
+        try:
+            rows.append(parse_schedule(data))
+            errors.append(None)
+        except ValidationError as e:
+            rows.append(None)
+            errors.append(str(e))
+    return rows, errors